@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+"""Benchmarks of the slowest steps of Fropag.
+
+Each benchmark checks its optimized version gives the same result
+as the reference one, and prints how long both took.
+Run python benchmarks.py --help to list them."""
+# -*- coding: utf-8 -*-
+import argparse
+import datetime
+import itertools
+import os
+import random
+import time
+
+from bs4 import BeautifulSoup
+from sqlalchemy import create_engine, func, or_, and_
+
+import config
+from process.reader import compare, extract_script_and_style
+from process.reader import extract_content_and_fingerprints
+from process import archive
+import database
+from model import pivot
+from model.core import join_from_words_to_publication
+from model.publication import Word, Publication, Forbidden, DailyWordCount
+
+def timed(function, *args):
+    '''Call function with args, return its result
+    and the time it took.'''
+    time0 = time.time()
+    result = function(*args)
+    return result, time.time() - time0
+
+def synthetic_front_page(seed, articles=400, shared=0.7):
+    '''Build a portal-like front page : a large menu and footer
+    that never change, and articles blocks, a part of which
+    (shared) are the same from one seed to the next.'''
+    rand = random.Random(seed)
+    menu = ''.join('<li class="nav-item"><a href="/rubrique/{0}">'
+                   'Rubrique {0}</a></li>'.format(i) for i in range(300))
+    blocks = []
+    for i in range(articles):
+        number = i if rand.random() < shared else seed * articles + i
+        blocks.append('<article class="teaser"><h2><a href="/article/{0}">'
+                      'Titre de l\'article {0}</a></h2><div class="meta">'
+                      '<span class="author">Auteur {1}</span><time>{0}</time>'
+                      '</div><p class="chapo">Premier paragraphe de '
+                      'l\'article {0}, avec quelques mots.</p></article>'.\
+                      format(number, number % 17))
+    footer = ''.join('<p class="legal">Mention {0}</p>'.format(i)
+                     for i in range(100))
+    return ('<html><head><script>var x = {0};</script></head><body>'
+            '<nav><ul>{1}</ul></nav><main>{2}</main><footer>{3}</footer>'
+            '</body></html>').format(seed, menu, ''.join(blocks), footer)
+
+def front_page_pairs(folder):
+    '''Couples of (previous, new) front pages : successive
+    snapshots if folder is a corpus archive, successive files
+    if it is a plain folder of HTML pages, or synthetic pages.'''
+    if folder is None:
+        return [(synthetic_front_page(1), synthetic_front_page(2))]
+    if os.path.isdir(os.path.join(folder, "index")):
+        archive.ARCHIVE_DIR = folder
+        pairs = []
+        for key in archive.archived_keys():
+            digests = [digest for _, digest in archive.snapshots_of(key)]
+            pairs.extend((archive.read_snapshot(previous),
+                          archive.read_snapshot(new))
+                         for previous, new in zip(digests, digests[1:])
+                         if previous != new)
+        return pairs
+    pages = []
+    for root, dirs, files in os.walk(folder):
+        for name in sorted(files):
+            with open(os.path.join(root, name), 'r') as page_file:
+                pages.append(page_file.read())
+    return list(zip(pages, pages[1:]))
+
+def naive_compare(previous, new):
+    '''The former version of reader.compare : a list scan
+    with deep Tag equality for each tag of the new page.'''
+    to_remove = []
+    tags_of_previous = previous.find_all(True)
+    for new_tag in new.find_all(True):
+        if new_tag in tags_of_previous:
+            to_remove.append(new_tag)
+    [tag.decompose() for tag in to_remove]
+
+def bench_compare(args):
+    '''Template removal : naive_compare against reader.compare.'''
+    naive_total = fast_total = 0
+    for previous, new in front_page_pairs(args.folder):
+        texts = []
+        for function in (naive_compare, compare):
+            old_soup = BeautifulSoup(previous, 'html.parser')
+            new_soup = BeautifulSoup(new, 'html.parser')
+            extract_script_and_style(old_soup)
+            extract_script_and_style(new_soup)
+            _, duration = timed(function, old_soup, new_soup)
+            texts.append(new_soup.get_text(separator=' ').strip())
+            if function is compare:
+                fast_total += duration
+            else:
+                naive_total += duration
+        if texts[0] != texts[1]:
+            print("[FAILED] - compare differs from the naive version.")
+    print("Naive compare : {:.3f} secs. Fingerprint compare : {:.3f} secs.".\
+          format(naive_total, fast_total))
+
+def bench_extraction(args):
+    '''Text extraction : BeautifulSoup against lxml.'''
+    totals = {}
+    same_text = same_prints = 0
+    pairs = front_page_pairs(args.folder)
+    for previous, new in pairs:
+        results = []
+        for backend in ('beautifulsoup', 'lxml'):
+            config.EXTRACTION_BACKEND = backend
+            result, duration = timed(extract_content_and_fingerprints,
+                                     previous, new)
+            totals[backend] = totals.get(backend, 0) + duration
+            results.append(result)
+        (bs_text, bs_prints), (lxml_text, lxml_prints) = results
+        same_text += bs_text.split() == lxml_text.split()
+        same_prints += set(bs_prints) == set(lxml_prints)
+    print("Same words for {} pages out of {}, same fingerprints for {}.".\
+          format(same_text, len(pairs), same_prints))
+    print("BeautifulSoup : {:.3f} secs. lxml : {:.3f} secs.".\
+          format(totals['beautifulsoup'], totals['lxml']))
+
+def naive_to_stats(elems, first_column_name):
+    '''The former version of core.to_stats : two sorts
+    and nested groupbys.'''
+    by1 = sorted(elems, key=lambda k: k[1])
+    by0 = sorted(elems, key=lambda k: k[0])
+    column2 = itertools.groupby(by1, lambda x: x[1])
+    column2 = [k for k, v in column2]
+    column2.insert(0, first_column_name)
+    grouped = itertools.groupby(by0, lambda y: y[0])
+    res = []
+    for k, v in grouped:
+        list_value = list(v)
+        pertinent = [list(v)[2:] for v in list_value]
+        pertinent = list(itertools.chain(*pertinent))
+        pertinent.insert(0, k)
+        res.append(pertinent)
+    return [column2] + res
+
+def synthetic_history(years, publications):
+    '''(date, publication, count) for every day of some
+    years and every publication, in the order of a query.'''
+    rand = random.Random(0)
+    first = datetime.date(2014, 1, 1)
+    names = ['Publication {:02d}'.format(i) for i in range(publications)]
+    return [((first + datetime.timedelta(days=d)).strftime('%Y/%m/%d'),
+             name, rand.randint(0, 20))
+            for d in range(365 * years) for name in names]
+
+def bench_pivot(args):
+    '''History pivot : the former to_stats against pivot.'''
+    history = synthetic_history(args.years, args.publications)
+    reference, naive_time = timed(naive_to_stats, history, 'date')
+    lines, pivot_time = timed(pivot.to_rows, history, 'date')
+    if lines != reference:
+        print("[FAILED] - pivot differs from to_stats.")
+    _, columnar_time = timed(pivot.to_columns, history, 'dates')
+    print("{} values. to_stats : {:.3f} secs. Pivot : {:.3f} secs. "
+          "Columnar output : {:.3f} secs.".format(len(history), naive_time,
+                                                  pivot_time, columnar_time))
+
+def naive_forbidden_join(q):
+    '''The former join_from_words_to_publication : an outer
+    join on forbidden, filtered by an OR of null checks.'''
+    return q.join(DailyWordCount, Word.id == DailyWordCount.word_id).\
+      join(Publication, Publication.id == DailyWordCount.publication_id).\
+      outerjoin(Forbidden, Forbidden.word_id == Word.id).\
+      filter(or_(and_(Forbidden.word_id == None,
+                      Forbidden.publication_id == None),
+                 and_(Forbidden.word_id != None,
+                      Forbidden.publication_id != Publication.id)))
+
+def synthetic_counts(args):
+    '''Fill the database with publications, words, daily counts
+    and a forbidden list : half of the forbidden words for every
+    publication, the others for one to three publications.'''
+    engine = database.get_engine()
+    rand = random.Random(0)
+    first = datetime.date(2014, 1, 1)
+    engine.execute(Publication.__table__.insert(),
+                   [{'id' : p + 1, 'name' : 'Publication {}'.format(p)}
+                    for p in range(args.publications)])
+    engine.execute(Word.__table__.insert(),
+                   [{'id' : w + 1, 'word' : 'mot{}'.format(w), 'proper' : False}
+                    for w in range(args.words)])
+    for d in range(args.days):
+        engine.execute(DailyWordCount.__table__.insert(),
+                       [{'publication_id' : p + 1, 'word_id' : w,
+                         'day' : first + datetime.timedelta(days=d),
+                         'count' : rand.randint(1, 5)}
+                        for p in range(args.publications)
+                        for w in rand.sample(range(1, args.words + 1), 200)])
+    forbidden = []
+    for w in rand.sample(range(1, args.words + 1), args.forbidden):
+        if rand.random() < 0.5:
+            forbidden.append({'word_id' : w, 'publication_id' : None})
+        else:
+            forbidden.extend({'word_id' : w, 'publication_id' : p + 1}
+                             for p in rand.sample(range(args.publications),
+                                                  rand.randint(1, 3)))
+    engine.execute(Forbidden.__table__.insert(), forbidden)
+    return len(forbidden)
+
+def bench_forbidden(args):
+    '''Forbidden words : outer join and OR against NOT EXISTS.'''
+    database.engine = create_engine(args.uri)
+    database.Base.metadata.create_all(database.engine)
+    forbidden = synthetic_counts(args)
+    def counts(join):
+        '''Total count of every allowed word.'''
+        q = database.db_session.query(Word.word,
+                                      func.sum(DailyWordCount.count))
+        return dict(join(q).group_by(Word.word).all())
+    naive, naive_time = timed(counts, naive_forbidden_join)
+    fast, fast_time = timed(counts, join_from_words_to_publication)
+    inflated = sum(1 for w in fast if naive.get(w) != fast[w])
+    print("{} forbidden rows. {} words counted. Outer join : {:.3f} secs. "
+          "NOT EXISTS : {:.3f} secs.".format(forbidden, len(fast),
+                                             naive_time, fast_time))
+    print("{} words miscounted by the outer join ; {} forbidden words "
+          "it still counts.".format(inflated, len(set(naive) - set(fast))))
+    database.Base.metadata.drop_all(database.engine)
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers()
+
+    compare_parser = subparsers.add_parser("compare",
+                                           help="Template removal.")
+    compare_parser.add_argument("--folder",
+                                help="Folder of saved front pages,\
+                                      instead of synthetic ones.")
+    compare_parser.set_defaults(func=bench_compare)
+
+    extraction_parser = subparsers.add_parser("extraction",
+                                              help="Text extraction.")
+    extraction_parser.add_argument("--folder",
+                                   help="Folder of saved front pages,\
+                                         instead of synthetic ones.")
+    extraction_parser.set_defaults(func=bench_extraction)
+
+    pivot_parser = subparsers.add_parser("pivot",
+                                         help="Pivot of word histories.")
+    pivot_parser.add_argument("--years", type=int, default=3,
+                              help="Years of daily history.")
+    pivot_parser.add_argument("--publications", type=int, default=50,
+                              help="Number of publications.")
+    pivot_parser.set_defaults(func=bench_pivot)
+
+    forbidden_parser = subparsers.add_parser("forbidden",
+                                             help="Exclusion of forbidden\
+                                                   words.")
+    forbidden_parser.add_argument("--uri", default="sqlite://",
+                                  help="Database to fill, then empty.\
+                                        An in-memory SQLite by default.")
+    forbidden_parser.add_argument("--publications", type=int, default=20)
+    forbidden_parser.add_argument("--words", type=int, default=20000)
+    forbidden_parser.add_argument("--days", type=int, default=60)
+    forbidden_parser.add_argument("--forbidden", type=int, default=5000,
+                                  help="Number of forbidden words.")
+    forbidden_parser.set_defaults(func=bench_forbidden)
+
+    args = parser.parse_args()
+    if hasattr(args, "func"):
+        args.func(args)
+    else:
+        parser.print_help()
+
+if __name__ == "__main__":
+    main()
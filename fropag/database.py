@@ -1,11 +1,41 @@
 # -*- coding: utf-8 -*-
+import contextlib
+import os
 from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool
 from sqlalchemy.orm import sessionmaker, scoped_session, create_session
 from sqlalchemy.ext.declarative import declarative_base
 import config
 
-def set_engine(uri, user, password, host, port, name):
-    global engine
+def make_engine(connection_string, statement_timeout=None):
+    '''Engine with the pool settings of config.py. Connections
+    are checked before being used, and, with PostgreSQL, a
+    statement running more than statement_timeout seconds
+    is cancelled. Embedded databases (see model.analytics) are
+    opened read only, for each session.'''
+    backend = make_url(connection_string).get_backend_name()
+    if backend != 'postgresql':
+        connect_args = {'read_only' : True} if backend == 'duckdb' else {}
+        return create_engine(connection_string, poolclass=NullPool,
+                             connect_args=connect_args)
+    connect_args = {}
+    if statement_timeout:
+        connect_args['options'] = '-c statement_timeout={}'.\
+                                  format(int(statement_timeout * 1000))
+    return create_engine(connection_string,
+                         isolation_level="AUTOCOMMIT",
+                         pool_size=config.DB_POOL_SIZE,
+                         max_overflow=config.DB_MAX_OVERFLOW,
+                         pool_recycle=config.DB_POOL_RECYCLE,
+                         pool_pre_ping=True,
+                         connect_args=connect_args)
+
+def set_engine(uri, user, password, host, port, name, read_uri=None):
+    '''Create the engine of the primary database, and the one
+    the read functions use : read_uri, the read replica of
+    config.py, or none of them.'''
+    global engine, read_engine, connection_strings
     config.check_config()
     connection_string = ''.join([uri,
                                  user,
@@ -17,12 +47,31 @@ def set_engine(uri, user, password, host, port, name):
                                  port,
                                  '/',
                                  name])
-    engine = create_engine(connection_string, isolation_level="AUTOCOMMIT")
+    connection_strings = (connection_string, read_uri or config.DB_READ_URI)
+    engine, read_engine = make_engines(*connection_strings)
     Base.metadata.bind = engine
+    # Sessions opened before are bound to the previous engines
+    db_session.remove()
+    read_session.remove()
+
+def make_engines(connection_string, read_connection_string):
+    '''The engine of the primary database, and the one
+    to read from, or None if there is none.'''
+    primary = make_engine(connection_string,
+                          config.DB_WRITE_STATEMENT_TIMEOUT)
+    replica = None
+    if read_connection_string:
+        replica = make_engine(read_connection_string,
+                              config.DB_READ_STATEMENT_TIMEOUT)
+    return primary, replica
 
 def get_engine():
     return engine
 
+def get_read_engine():
+    '''Engine of the read replica, or of the primary database.'''
+    return read_engine if read_engine is not None else engine
+
 def get_session():
     if engine is None:
         set_engine(config.DB_URI,
@@ -32,6 +81,41 @@ def get_session():
                    config.DB_PORT,
                    config.DB_NAME)
 
+@contextlib.contextmanager
+def reads_from_primary():
+    '''Make read_session read from the primary database in this
+    block, e.g. to use what was just written, not yet replicated.'''
+    session = read_session()
+    replica = session.bind
+    session.bind = engine
+    try:
+        yield
+    finally:
+        session.bind = replica
+
+def recreate_engines():
+    '''In a forked process, replace the engines of the parent by new
+    ones. The engines and sessions of the parent are kept aside, never
+    used nor closed : their connections are still the parent's.'''
+    global engine, read_engine
+    if connection_strings is None:
+        return
+    _inherited.append((engine, read_engine))
+    for session in (db_session, read_session):
+        if session.registry.has():
+            _inherited.append(session.registry())
+            session.registry.clear()
+    engine, read_engine = make_engines(*connection_strings)
+    Base.metadata.bind = engine
+
 Base = declarative_base()
 engine = None
+read_engine = None
+connection_strings = None
+# Engines and sessions a forked process got from its parent
+_inherited = []
 db_session = scoped_session(lambda: create_session(bind=engine))
+# Session of the read functions, bound to the analytics database
+# or the read replica if there is one
+read_session = scoped_session(lambda: create_session(bind=get_read_engine()))
+os.register_at_fork(after_in_child=recreate_engines)
@@ -2,12 +2,18 @@
 """Console-level entry point."""
 # -*- coding: utf-8 -*-
 import argparse
+import datetime
 import os
 import logging
 import logging.handlers
 from model.core import follow_publication, delete_front_page
 from model.core import init_db, see_words_for, boot_sql_alchemy
-from process.read_process import read_only, read_every
+from model.core import rebuild_top_words
+from model.rollup import rebuild_rollups
+from model.partition import partition_word_counts, forget_months_before
+from model.analytics import sync_analytics, ensure_analytics
+from process.read_process import read_only, read_every, lexicon_report
+from process.replay import replay
 from config import ConfigException
 
 def set_up(args):
@@ -24,7 +30,25 @@ def read_publications(args):
     else:
         return read_every()
 
+def tagger_lexicon(args):
+    return lexicon_report(args.build)
+
+def replay_corpus(args):
+    return replay(args.folder, args.pub)
+
+def rebuild(args):
+    return '\n'.join([rebuild_rollups(), rebuild_top_words()])
+
+def partitions(args):
+    if args.forget_before:
+        return forget_months_before(args.forget_before)
+    return partition_word_counts()
+
+def copy_analytics(args):
+    return sync_analytics()
+
 def view_words(args):
+    ensure_analytics()
     return see_words_for(args.publication_name, args.proper, args.limit)
 
 def add_publication(args):
@@ -73,11 +97,56 @@ def main():
                             one given publication. Can be chained.\
                             Use the publication names.")
 
+    lexicon = subparsers.add_parser("lexicon",
+                                    help="Compare the lexicon tagger with\
+                                          the Stanford one on the corpus.")
+    lexicon.add_argument("--build",
+                         action="store_true",
+                         help="Learn the lexicon from the corpus first,\
+                               but the front pages it is compared on.")
+
+    replay_parser = subparsers.add_parser("replay",
+                                          help="Analyze again saved\
+                                                front pages, without\
+                                                reading them.")
+    replay_parser.add_argument("folder", nargs="?", default="corpus",
+                               help="Corpus archive, or folder with a\
+                                     folder of dated pages for each\
+                                     publication.")
+    replay_parser.add_argument("--pub",
+                               action='append',
+                               help="Replay only this publication.\
+                                     Can be chained.")
+
+    rollups = subparsers.add_parser("rollups",
+                                    help="Compute the daily word counts\
+                                          and the rankings again from\
+                                          every front page.")
+
+    partition = subparsers.add_parser("partitions",
+                                      help="Move the word counts of an\
+                                            older database into monthly\
+                                            partitions.")
+    partition.add_argument("--forget-before",
+                           type=lambda day: datetime.datetime.\
+                                            strptime(day, '%Y-%m-%d').date(),
+                           help="Instead, delete everything saved before\
+                                 the month of this day (YYYY-MM-DD).")
+
+    analytics = subparsers.add_parser("analytics",
+                                      help="Copy the data of the charts\
+                                            to the analytics database.")
+
     follow.set_defaults(func=add_publication)
     words.set_defaults(func=view_words)
     init.set_defaults(func=set_up)
     read.set_defaults(func=read_publications)
     delete.set_defaults(func=delete_fp)
+    lexicon.set_defaults(func=tagger_lexicon)
+    replay_parser.set_defaults(func=replay_corpus)
+    rollups.set_defaults(func=rebuild)
+    partition.set_defaults(func=partitions)
+    analytics.set_defaults(func=copy_analytics)
     args = parser.parse_args()
 
     if hasattr(args, "func"):
@@ -0,0 +1,177 @@
+'''Embedded copy of the data of the charts.
+
+The chart functions of model.core (get_all_tops, get_history_for,
+etc.) only read the publications, the words, the forbidden words,
+the daily rollups, the rankings and the generation of the data.
+With an analytics backend, those tables are copied after every
+change in an embedded database file, DuckDB (columnar) if it is
+installed, or SQLite, and read_session reads from it : the
+group-bys of the charts run in the web process, without a round
+trip to PostgreSQL.
+The copy is written in a new file, which then replaces the
+previous one. Readers open the file for each session, so they
+never wait for, nor see, a copy being written.'''
+# -*- coding: utf-8 -*-
+import logging
+import os
+import threading
+import time
+import uuid
+
+from sqlalchemy import create_engine, MetaData, Enum, String
+from sqlalchemy.pool import NullPool
+
+import config
+from database import get_engine
+from model.publication import Publication, Word, Forbidden, TopWords
+from model.publication import DailyWordCount, DailyFrontPageCount
+from model.publication import DataGeneration
+from model.rollup import transaction
+
+try:
+    import duckdb_engine
+except ImportError:
+    # DuckDB is optional : SQLite will be used instead.
+    duckdb_engine = None
+
+_log = logging.getLogger('fropag.analytics')
+
+# Tables copied in the analytics database, the referenced ones first.
+TABLES = [Publication.__table__, Word.__table__, Forbidden.__table__,
+          DailyWordCount.__table__, DailyFrontPageCount.__table__,
+          TopWords.__table__, DataGeneration.__table__]
+# Rows copied by a single insert
+ROWS_PER_INSERT = 10000
+# Directory ANALYTICS_PATH is relative to : the one of fropag, so that
+# the reader and the website use the same file wherever they run.
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def analytics_backend():
+    '''The configured backend, or None. SQLite replaces
+    DuckDB if it is not installed.'''
+    if config.ANALYTICS_BACKEND == 'duckdb' and duckdb_engine is None:
+        return 'sqlite'
+    return config.ANALYTICS_BACKEND
+
+def analytics_uri(backend, path, read_only=True):
+    """Connection string of an analytics database. DuckDB is
+    opened read only by database.make_engine.
+
+    >>> analytics_uri('sqlite', '/tmp/analytics.db')
+    'sqlite:///file:/tmp/analytics.db?mode=ro&uri=true'
+    >>> analytics_uri('duckdb', '/tmp/analytics.db', read_only=False)
+    'duckdb:////tmp/analytics.db'
+    """
+    if backend == 'sqlite' and read_only:
+        return 'sqlite:///file:{}?mode=ro&uri=true'.format(path)
+    return '{}:///{}'.format(backend, path)
+
+def analytics_path():
+    '''Absolute path of the analytics database.'''
+    return os.path.join(BASE_DIR, config.ANALYTICS_PATH)
+
+def analytics_read_uri():
+    '''Connection string the read functions use, or None
+    if there is no analytics backend.'''
+    backend = analytics_backend()
+    if backend is None:
+        return None
+    return analytics_uri(backend, analytics_path())
+
+def analytics_tables():
+    """Copies of the tables of the charts, which any embedded
+    database can create : their ids are copied, not generated,
+    and enums are plain strings.
+
+    >>> [str(c.type) for c in analytics_tables()[0].columns]
+    ['INTEGER', 'VARCHAR', 'VARCHAR', 'VARCHAR(15)']
+    """
+    metadata = MetaData()
+    tables = [table.tometadata(metadata) for table in TABLES]
+    for table in tables:
+        for column in table.columns:
+            column.autoincrement = False
+            if isinstance(column.type, Enum):
+                column.type = String(column.type.length)
+    return tables
+
+# Held while the tables are copied, so that the copies of a process
+# replace the analytics database one after the other
+_syncing = threading.RLock()
+# Set when the tables changed since the last copy started
+_sync_wanted = threading.Event()
+
+def sync_analytics():
+    '''Copy the tables of the charts from the primary database,
+    read in a single snapshot, into a new analytics database,
+    which then replaces the previous one.'''
+    backend = analytics_backend()
+    if backend is None:
+        return "No analytics backend."
+    with _syncing:
+        return copy_analytics(backend)
+
+def copy_analytics(backend):
+    '''sync_analytics, once no other copy runs in this process.
+    The new file is named uniquely, so that the copies of other
+    processes do not write in it.'''
+    time0 = time.time()
+    path = analytics_path()
+    new_path = '{}.{}.new'.format(path, uuid.uuid4().hex)
+    target = create_engine(analytics_uri(backend, new_path, read_only=False),
+                           poolclass=NullPool)
+    copied = 0
+    try:
+        tables = analytics_tables()
+        tables[0].metadata.create_all(target)
+        with transaction("REPEATABLE READ") as source, \
+             target.begin() as connection:
+            for table, copy in zip(TABLES, tables):
+                result = source.execution_options(stream_results=True).\
+                         execute(table.select())
+                while True:
+                    rows = result.fetchmany(ROWS_PER_INSERT)
+                    if not rows:
+                        break
+                    connection.execute(copy.insert(),
+                                       [dict(row) for row in rows])
+                    copied += len(rows)
+    except:
+        target.dispose()
+        if os.path.exists(new_path):
+            os.remove(new_path)
+        raise
+    target.dispose()
+    os.replace(new_path, path)
+    result = "Copied {} rows to the {} analytics database in {:.1f} secs.".\
+             format(copied, backend, time.time() - time0)
+    _log.info(result)
+    return result
+
+def ensure_analytics():
+    '''Copy the tables of the charts, unless it was done.'''
+    if analytics_backend() is not None and \
+       not os.path.exists(analytics_path()):
+        sync_analytics()
+
+def sync_analytics_later():
+    '''Copy the tables of the charts in a thread, not to keep
+    e.g. a web request waiting. Changes made while a copy is
+    running are copied by the next one.'''
+    if analytics_backend() is None:
+        return
+    _sync_wanted.set()
+    threading.Thread(target=sync_if_wanted).start()
+
+def sync_if_wanted():
+    '''Copy the tables of the charts, unless another thread
+    did it since they changed.'''
+    with _syncing:
+        if not _sync_wanted.is_set():
+            return
+        _sync_wanted.clear()
+        try:
+            sync_analytics()
+        except Exception as exception:
+            _log.error('Could not copy the analytics database : %s',
+                       exception)
@@ -1,13 +1,21 @@
 '''Provide various utilities to extract information
 from the database.'''
 # -*- coding: utf-8 -*-
-import itertools
-from sqlalchemy import func, desc, case, cast, Numeric
-from sqlalchemy import text
-from sqlalchemy.sql.expression import literal, or_, and_
+import datetime
+import json
+from sqlalchemy import func, desc, case, cast, Numeric, select, tuple_
+from sqlalchemy.sql.expression import literal, literal_column, or_, and_, exists
 from sqlalchemy.orm.exc import NoResultFound
 from database import Base, get_engine, set_engine, db_session
+from database import read_session, reads_from_primary
 from model.publication import Publication, Word, FrontPage, WordCount, Forbidden
+from model.publication import DailyWordCount, DailyFrontPageCount, TopWords
+from model.publication import DataGeneration
+from model.rollup import transaction, days_of_front_pages, refresh_days
+from model.rollup import forget_publication
+from model.pivot import to_rows, to_columns
+from model.analytics import sync_analytics_later
+from model.analytics import analytics_read_uri
 import config
 
 # EXCEPTIONS
@@ -28,7 +36,7 @@ def get_publication(name):
     '''Given the name of a publication, return, if it exists,
     the Publication object.'''
     try:
-        return db_session.query(Publication).\
+        return read_session.query(Publication).\
                           filter(Publication.name == name).one()
     except:
         raise NonExistingDataException('No such publication')
@@ -43,7 +51,7 @@ def get_word_data(word):
     # However, proper nouns are to be recorded with a capital
     # first letter, whereas common nouns are lowered before
     # being inserted. (See the get_stats function of the analyze module).
-    res = db_session.query(Word,
+    res = read_session.query(Word,
                            Forbidden.word_id,
                            Forbidden.publication_id,
                            Publication.id,
@@ -70,7 +78,7 @@ def get_publication_tops(names):
     # This is rather ugly. But getting limited result for grouped queries
     # is rather impracticable. Best solution will be to cache this result.
     results = {}
-    for (p_id, p_name) in db_session.query(Publication.id, Publication.name).\
+    for (p_id, p_name) in read_session.query(Publication.id, Publication.name).\
                         filter(Publication.name.in_(names)):
         results[p_name] = count_words_for(p_id)
     return results
@@ -90,41 +98,103 @@ def count_words_for(p_id):
     q = word_counting_query().filter(Publication.id == p_id)
     return separate_propers_and_commons(q)
 
-def get_publication_frequency(names):
-    '''Count the 10 most frequent words for 
-    the given publications, identified by their names.'''
+def get_publication_frequency(names, nmb_return=10):
+    '''Count the nmb_return most frequent words for
+    the given publications, identified by their names.
+    Every publication is ranked at once, in a single query.'''
+    fpcounts = read_session.query(DailyFrontPageCount.publication_id.\
+                                label('publication_id'),
+                                cast(func.sum(DailyFrontPageCount.count),
+                                     Numeric(10, 2)).label('fpcount')).\
+               group_by(DailyFrontPageCount.publication_id).subquery()
+    # This should avoid any div by zero error
+    frequency = cast(case([(fpcounts.c.fpcount == 0, 0),],
+                          else_=(decimal_sum(DailyWordCount.count) /
+                                 fpcounts.c.fpcount)),
+                     Numeric(10, 2))
+    q = read_session.query(Word.word,
+                         frequency.label('frequency'),
+                         func.min(DailyWordCount.day).label('mindate'),
+                         func.max(DailyWordCount.day).label('maxdate'),
+                         Word.proper,
+                         Publication.id.label('publication_id'))
+    q = join_from_words_to_publication(q).\
+        join(fpcounts, fpcounts.c.publication_id == Publication.id).\
+        filter(Publication.name.in_(names)).\
+        group_by(Publication.id, Word.word, Word.proper, fpcounts.c.fpcount)
+    return rank_by_publication(q.subquery(), names, nmb_return)
+
+def rank_by_publication(grouped, names, nmb_return):
+    '''Given a grouped subquery of words, their value, dates,
+    proper status and publication id, keep the nmb_return first
+    propers and commons of every publication with the given names,
+    with the datespan of each publication.'''
+    ranked = read_session.query(grouped.c.publication_id,
+                              grouped.c.word,
+                              grouped.c.frequency,
+                              grouped.c.proper,
+                              func.row_number().\
+                              over(partition_by=(grouped.c.publication_id,
+                                                 grouped.c.proper),
+                                   order_by=(desc(grouped.c.frequency),
+                                             grouped.c.word)).\
+                              label('rank'),
+                              func.min(grouped.c.mindate).\
+                              over(partition_by=grouped.c.publication_id).\
+                              label('mindate'),
+                              func.max(grouped.c.maxdate).\
+                              over(partition_by=grouped.c.publication_id).\
+                              label('maxdate')).subquery()
+    # Publications without any word are kept, with empty rankings.
+    rows = read_session.query(Publication.name, ranked.c.word,
+                            ranked.c.frequency, ranked.c.proper,
+                            ranked.c.mindate, ranked.c.maxdate).\
+           outerjoin(ranked, and_(ranked.c.publication_id == Publication.id,
+                                  ranked.c.rank <= nmb_return)).\
+           filter(Publication.name.in_(names)).\
+           order_by(Publication.name, ranked.c.rank)
     results = {}
-    pubs_and_fp_number = db_session.query(Publication.id, Publication.name)
-    for (p_id, p_name) in pubs_and_fp_number:
-        results[p_name] = count_frequency_for(p_id)
+    for name, word, value, proper, mindate, maxdate in rows:
+        result = results.setdefault(name, {'propers' : [], 'commons' : []})
+        if word is None:
+            continue
+        result['propers' if proper else 'commons'].append((word, value))
+        if not proper:
+            result['mindate'] = mindate.strftime('%d/%m/%Y')
+            result['maxdate'] = maxdate.strftime('%d/%m/%Y')
     return results
 
 def get_number_of_all_frontpages():
     '''Return the number of frontpages recorded for every publications.'''
     # Count as cast in order to have a valid division
-    return db_session.query(cast(func.count(FrontPage.id), Numeric(10, 2)).\
+    return read_session.query(cast(func.coalesce(
+                                    func.sum(DailyFrontPageCount.count), 0),
+                                 Numeric(10, 2)).\
                             label('fpcount'))
 
 def get_number_of_frontpages_for(pub_id):
     '''Return the number of frontpages registered
     for one publication, identified by its primary key.'''
     return get_number_of_all_frontpages().\
-           filter(FrontPage.publication_id == pub_id)
+           filter(DailyFrontPageCount.publication_id == pub_id)
+
+def decimal_sum(column):
+    '''Sum of a column, as a decimal : embedded analytics
+    databases would make a division of integers.'''
+    return func.sum(column) * literal_column("1.0")
 
 def get_frequency_query(subquery):
     '''Given a subquery that let us get the number of frontpages,
     return the query needed to compute the frequency of word usages.'''
     # This should avoid any div by zero error
-    no_fp = case([(subquery.c.fpcount == 0, 0),],
-                 else_=cast((func.sum(WordCount.count) / subquery.c.fpcount),
-                            Numeric(10, 2))).\
-                 label('frequency')
-    q = db_session.query(Word.word,
+    no_fp = cast(case([(subquery.c.fpcount == 0, 0),],
+                      else_=(decimal_sum(DailyWordCount.count) /
+                             subquery.c.fpcount)),
+                 Numeric(10, 2)).label('frequency')
+    q = read_session.query(Word.word,
                          no_fp,
-                         func.min(FrontPage.time_of_publication).\
-                         label('mindate'),
-                         func.max(FrontPage.time_of_publication).\
-                         label('maxdate'))
+                         func.min(DailyWordCount.day).label('mindate'),
+                         func.max(DailyWordCount.day).label('maxdate'))
     return join_from_words_to_publication(q).\
            group_by(Word.word, subquery.c.fpcount)
 
@@ -138,38 +208,129 @@ def count_frequency_for(p_id):
     res = separate_propers_and_commons(q)
     return res
 
-def get_history_for(word):
-    '''Given a word, get how many times it appeared
-    for each frontpage of each publications followed.'''
-    # This is way to tiresome to do with ORM.
-    # So... let's do it the old way !
-    query = """select pubs.pubdate,
-                      p.name,
-                      coalesce(cnt.count, 0)
-               from 
-                    (select c.count, 
-                            to_char(f.time_of_publication, 'YYYY/MM/DD') 
-                            as pdate,
-                            p.id from wordcount c 
-                            left join frontpage f 
-                                on f.id = c.frontpage_id 
-                            left join publication p 
-                                on f.publication_id = p.id 
-                            left join word w 
-                                on c.word_id = w.id 
-                     where word = :x) cnt 
-                full outer join 
-                    (select 
-                        distinct to_char(f.time_of_publication, 'YYYY/MM/DD')
-                            as pubdate, 
-                        p.id from frontpage f 
-                        cross join publication p) pubs 
-                on cnt.id = pubs.id 
-                and cnt.pdate = pubs.pubdate
-                left outer join publication p on p.id = pubs.id;"""
-    return to_stats(get_engine().execute(text(query),
-                                         x=word).\
-                                 fetchall(), "date")
+# Buckets of the history of a word
+DAY = 'day'
+WEEK = 'week'
+MONTH = 'month'
+BUCKETS = (DAY, WEEK, MONTH)
+
+def bucket_start(day, bucket):
+    """First day of the bucket a day belongs to.
+    Weeks start on mondays.
+
+    >>> bucket_start(datetime.date(2014, 10, 17), 'week')
+    datetime.date(2014, 10, 13)
+    >>> bucket_start(datetime.date(2014, 10, 17), 'month')
+    datetime.date(2014, 10, 1)
+    """
+    if bucket == WEEK:
+        return day - datetime.timedelta(days=day.weekday())
+    if bucket == MONTH:
+        return day.replace(day=1)
+    return day
+
+def next_bucket(start, bucket):
+    """First day of the bucket after the one starting at start.
+
+    >>> next_bucket(datetime.date(2014, 12, 1), 'month')
+    datetime.date(2015, 1, 1)
+    """
+    if bucket == WEEK:
+        return start + datetime.timedelta(days=7)
+    if bucket == MONTH:
+        if start.month == 12:
+            return start.replace(year=start.year + 1, month=1)
+        return start.replace(month=start.month + 1)
+    return start + datetime.timedelta(days=1)
+
+def bucket_range(first, last, bucket):
+    """First day of every bucket from the one of first
+    to the one of last, both included.
+
+    >>> bucket_range(datetime.date(2014, 10, 30), datetime.date(2014, 11, 2), 'day')
+    [datetime.date(2014, 10, 30), datetime.date(2014, 10, 31), datetime.date(2014, 11, 1), datetime.date(2014, 11, 2)]
+    """
+    starts = []
+    current = bucket_start(first, bucket)
+    while current <= last:
+        starts.append(current)
+        current = next_bucket(current, bucket)
+    return starts
+
+def count_buckets(first, last, bucket):
+    """Number of buckets from the one of first to the one
+    of last, both included.
+
+    >>> count_buckets(datetime.date(2014, 10, 17), datetime.date(2015, 1, 2), 'month')
+    4
+    >>> count_buckets(datetime.date(2014, 10, 19), datetime.date(2014, 10, 20), 'week')
+    2
+    """
+    first, last = bucket_start(first, bucket), bucket_start(last, bucket)
+    if bucket == WEEK:
+        return (last - first).days // 7 + 1
+    if bucket == MONTH:
+        return (last.year - first.year) * 12 + last.month - first.month + 1
+    return (last - first).days + 1
+
+def get_history_for(word, start=None, end=None, bucket=DAY, columnar=False):
+    '''Given a word, get how many times it appeared for each
+    publication followed, by day, week or month (the bucket),
+    from start to end (dates, both optional : by default, from
+    the first to the last front page).
+    Counts are read from the daily rollup, for this word only ;
+    buckets where the word was not used are filled with 0.
+    The result is a list of lines (see to_stats), or, if columnar
+    is True, the dates and the series of each publication.
+    A span of more than config.HISTORY_MAX_BUCKETS buckets
+    raises a ValueError.'''
+    if bucket not in BUCKETS:
+        raise ValueError("Unknown bucket {}.".format(bucket))
+    if start is None or end is None:
+        first, last = read_session.query(func.min(DailyFrontPageCount.day),
+                                       func.max(DailyFrontPageCount.day)).one()
+        start = start or first
+        end = end or last
+    publications = [name for (name,) in read_session.query(Publication.name)]
+    if start is None or end is None or start > end:
+        return bucket_history([], publications, start, end, bucket, columnar)
+    q = read_session.query(Publication.name,
+                         DailyWordCount.day,
+                         func.sum(DailyWordCount.count)).\
+        join(DailyWordCount, DailyWordCount.publication_id == Publication.id).\
+        join(Word, Word.id == DailyWordCount.word_id).\
+        filter(Word.word == word).\
+        filter(DailyWordCount.day >= start).\
+        filter(DailyWordCount.day <= end).\
+        group_by(Publication.name, DailyWordCount.day)
+    return bucket_history(q, publications, start, end, bucket, columnar)
+
+def bucket_history(day_counts, publications, start, end, bucket=DAY,
+                   columnar=False):
+    """Given the (publication name, day, count) of a word, sum
+    them by bucket, from start to end, 0 where the word was not
+    used, and give the result as get_history_for does.
+    More than config.HISTORY_MAX_BUCKETS buckets raise a ValueError.
+
+    >>> bucket_history([('A', datetime.date(2014, 10, 17), 2)], ['A', 'B'],
+    ...                datetime.date(2014, 10, 16), datetime.date(2014, 10, 17))
+    [['date', 'A', 'B'], ['2014/10/16', 0, 0], ['2014/10/17', 2, 0]]
+    """
+    if start is None or end is None or start > end:
+        return to_columns([], "dates") if columnar else to_stats([], "date")
+    if count_buckets(start, end, bucket) > config.HISTORY_MAX_BUCKETS:
+        raise ValueError("More than {} {}s from {} to {}.".format(
+            config.HISTORY_MAX_BUCKETS, bucket, start, end))
+    counts = {}
+    for name, day, count in day_counts:
+        key = (bucket_start(day, bucket), name)
+        counts[key] = counts.get(key, 0) + count
+    history = [(day.strftime('%Y/%m/%d'), name, counts.get((day, name), 0))
+               for day in bucket_range(start, end, bucket)
+               for name in publications]
+    if columnar:
+        return to_columns(history, "dates")
+    return to_stats(history, "date")
 
 def to_stats(elems, first_column_name):
     '''Given a list of tuples, typically a SQL query result,
@@ -182,25 +343,12 @@ def to_stats(elems, first_column_name):
     ... ('date2', 'newspaper3', 7)]
     >>> to_stats(a, 'date')
     [['date', 'newspaper1', 'newspaper2', 'newspaper3'], ['date1', 2, 3, 4], ['date2', 5, 6, 7]]
+
+    Missing values are 0, so columns stay aligned.
+    >>> to_stats(a[1:], 'date')
+    [['date', 'newspaper1', 'newspaper2', 'newspaper3'], ['date1', 0, 3, 4], ['date2', 5, 6, 7]]
     '''
-    # Sort
-    by1 = sorted(elems, key=lambda k: k[1])
-    by0 = sorted(elems, key=lambda k: k[0])
-    # Extract the 2nd column
-    column2 = itertools.groupby(by1, lambda x: x[1])
-    column2 = [k for k, v in column2]
-    column2.insert(0, first_column_name)
-    # Extract data without the 2nd column
-    grouped = itertools.groupby(by0, lambda y: y[0])
-    res = []
-    for k, v in grouped:
-        list_value = list(v)
-        pertinent = [list(v)[2:] for v in list_value]
-        pertinent = list(itertools.chain(*pertinent))
-        pertinent.insert(0, k)
-        res.append(pertinent)
-    # Concatenate both
-    return [column2] + res
+    return to_rows(elems, first_column_name)
 
 def get_all_tops():
     '''Get 10 most common and 10 most proper words
@@ -212,44 +360,47 @@ def get_all_tops():
 
 def get_publications():
     '''Return all tracked publication.'''
-    return db_session.query(Publication).all()
-
-def get_real_min_and_max(q):
-    '''From the word_counting_query or a similar one where
-    min and max of dates won't be absolute, due to the grouping,
-    subquery this query in order to get the real absolutes min
-    and max.'''
-    subq = q.subquery()
-    newq = db_session.query(func.min(subq.c.mindate),
-                            func.max(subq.c.maxdate))
-    return newq.first()
+    return read_session.query(Publication).all()
 
 def word_counting_query():
     '''Our main query for counting words and getting
     the minimum and maximum date where they appeared.'''
-    q = db_session.query(Word.word,
-                         func.sum(WordCount.count).label('sumcount'),
-                         func.min(FrontPage.time_of_publication).\
-                         label('mindate'),
-                         func.max(FrontPage.time_of_publication).\
-                         label('maxdate'))
+    q = read_session.query(Word.word,
+                         func.sum(DailyWordCount.count).label('sumcount'),
+                         func.min(DailyWordCount.day).label('mindate'),
+                         func.max(DailyWordCount.day).label('maxdate'))
     q = join_from_words_to_publication(q)
     return q.group_by(Word.word).order_by(desc('sumcount'))
 
 def separate_propers_and_commons(query, nmb_return=10):
     '''Given a query, separate the proper and common words.
-    Execute the query for both and return nmb_return rows.
-    If the results exist, also get the datespan of our data.'''
+    Return the nmb_return first rows for both.
+    If the results exist, also get the datespan of our data.
+    This is done in a single query : words are ranked among
+    the propers or the commons, and the datespan is computed
+    over every word, before keeping only the first ones.'''
+    grouped = query.add_columns(Word.proper).group_by(Word.proper).\
+                    order_by(None).subquery()
+    word, value = grouped.c.word, list(grouped.c)[1]
+    ranked = read_session.query(word, value, grouped.c.proper,
+                              func.row_number().\
+                              over(partition_by=grouped.c.proper,
+                                   order_by=(desc(value), word)).\
+                              label('rank'),
+                              func.min(grouped.c.mindate).over().\
+                              label('mindate'),
+                              func.max(grouped.c.maxdate).over().\
+                              label('maxdate')).subquery()
+    rows = read_session.query(ranked).\
+           filter(ranked.c.rank <= nmb_return).\
+           order_by(ranked.c.rank).all()
     results = {}
-    propers = query.filter(Word.proper == True).all()[:nmb_return]
-    commons = query.filter(Word.proper == False).all()[:nmb_return]
-    results['propers'] = [(r[0], r[1]) for r in propers]
-    results['commons'] = [(r[0], r[1]) for r in commons]
+    results['propers'] = [(r[0], r[1]) for r in rows if r[2]]
+    results['commons'] = [(r[0], r[1]) for r in rows if not r[2]]
     # For new publications
-    if len(commons) > 0:
-        minmax = get_real_min_and_max(query)
-        results['mindate'] = minmax[0].strftime('%d/%m/%Y')
-        results['maxdate'] = minmax[1].strftime('%d/%m/%Y')
+    if len(results['commons']) > 0:
+        results['mindate'] = rows[0][4].strftime('%d/%m/%Y')
+        results['maxdate'] = rows[0][5].strftime('%d/%m/%Y')
     return results
 
 def see_words_for(publication_name, proper, limit = 10):
@@ -259,19 +410,116 @@ def see_words_for(publication_name, proper, limit = 10):
     N.B. : mostly used for debug, this should disappear.'''
     q = word_counting_query().filter(Publication.name == publication_name).\
             filter(Word.proper == proper).\
-            all()[:limit]
+            limit(limit).all()
     return q
 
 def join_from_words_to_publication(q):
     '''Join for word counting queries. This join mostly
     make sure forbidden words, words that we don't want to
-    follow, are not going to be counted.'''
-    return q.join(WordCount, Word.id == WordCount.word_id).\
-      join(FrontPage, WordCount.frontpage_id == FrontPage.id).\
-      join(Publication, Publication.id == FrontPage.publication_id).\
-      outerjoin(Forbidden, Forbidden.word_id == Word.id).\
-      filter(or_(and_(Forbidden.word_id == None, Forbidden.publication_id == None),
-                (and_(Forbidden.word_id != None,Forbidden.publication_id != Publication.id))))
+    follow, are not going to be counted. Counts come from
+    the daily rollup, not from every front page.'''
+    return q.join(DailyWordCount, Word.id == DailyWordCount.word_id).\
+      join(Publication, Publication.id == DailyWordCount.publication_id).\
+      filter(~forbidden_for_all()).\
+      filter(~forbidden_for_publication())
+
+def forbidden_for_all():
+    '''Condition : the word is forbidden for every publication.'''
+    return exists().where(and_(Forbidden.word_id == Word.id,
+                               Forbidden.publication_id == None))
+
+def forbidden_for_publication():
+    '''Condition : the word is forbidden for this publication.'''
+    return exists().where(and_(Forbidden.word_id == Word.id,
+                               Forbidden.publication_id == Publication.id))
+
+# Snapshots of the rankings
+#------------------------------
+# Kinds of rankings : the tops of every publication, and for each
+# publication its 100 most used words and its 10 most frequent.
+ALL_TOPS = 'tops'
+MOST_USED = 'most_used'
+FREQUENCY = 'frequency'
+
+def rebuild_top_words():
+    '''Compute every ranking and save them in the top_words
+    table, replacing the previous ones. They are computed from
+    the primary database, which may be ahead of the replica ;
+    the analytics database then gets a copy of the new data, in
+    the background, not to keep e.g. an admin request waiting.'''
+    with reads_from_primary():
+        rankings = [(ALL_TOPS, 0, get_all_tops())]
+        publications = read_session.query(Publication.id,
+                                          Publication.name).all()
+        frequencies = get_publication_frequency([p_name for _, p_name
+                                                 in publications])
+        for (p_id, p_name) in publications:
+            rankings.append((MOST_USED, p_id,
+                             get_publication_most_used(p_name)))
+            rankings.append((FREQUENCY, p_id, frequencies[p_name]))
+    with transaction() as connection:
+        connection.execute(TopWords.__table__.delete())
+        connection.execute(TopWords.__table__.insert(),
+                           [{'kind' : kind, 'publication_id' : p_id,
+                             'content' : json.dumps(ranking, default=float)}
+                            for kind, p_id, ranking in rankings])
+    # Answers cached since the data changed used the former rankings
+    bump_generation()
+    sync_analytics_later()
+    return "Computed {} rankings.".format(len(rankings))
+
+def get_snapshot(kind, names=None):
+    '''Saved rankings of the given kind, by publication name,
+    for the publications with the given names, or all of them.'''
+    q = read_session.query(Publication.name, TopWords.content).\
+        join(TopWords, TopWords.publication_id == Publication.id).\
+        filter(TopWords.kind == kind)
+    if names is not None:
+        q = q.filter(Publication.name.in_(names))
+    return dict((name, json.loads(content)) for name, content in q)
+
+def snapshot_all_tops():
+    '''Same as get_all_tops, read from the saved rankings
+    if they were computed.'''
+    found = read_session.query(TopWords.content).\
+            filter(TopWords.kind == ALL_TOPS).first()
+    if found is None:
+        return get_all_tops()
+    return json.loads(found[0])
+
+def snapshot_publication_most_used(name):
+    '''Same as get_publication_most_used, read from the saved
+    rankings if they were computed.'''
+    found = get_snapshot(MOST_USED, [name])
+    if name not in found:
+        return get_publication_most_used(name)
+    return found[name]
+
+def snapshot_publication_frequency(names):
+    '''Most frequent words for the publications with the given
+    names, read from the saved rankings ; the missing ones
+    are computed.'''
+    results = get_snapshot(FREQUENCY, names)
+    missing = [name for name in names if name not in results]
+    if missing:
+        results.update(get_publication_frequency(missing))
+    return results
+
+# Generation of the data
+#------------------------------
+def get_generation():
+    '''Number of times the data changed : answers computed
+    for another generation are outdated.'''
+    return read_session.query(DataGeneration.generation).scalar() or 0
+
+def bump_generation():
+    '''Tell the caches the data changed.'''
+    table = DataGeneration.__table__
+    with transaction() as connection:
+        updated = connection.execute(table.update().\
+                                     values(generation=table.c.generation + 1))
+        if not updated.rowcount:
+            connection.execute(table.insert(), id=1, generation=1)
 
 # Update functions
 #------------------------------
@@ -283,7 +531,7 @@ def modify_word(id_w, proper, forbid_all, forbidden):
     db_session.query(Word).filter(Word.id == id_w).update({"proper": proper})
     # Then, remove every forbidden properties for this word
     for forb in db_session.query(Forbidden).filter(Forbidden.word_id == id_w):
-        db_session.delete(forbidden_all)
+        db_session.delete(forb)
     # Then if forbid_all : insert only word_id
     db_session.begin()
     if forbid_all:
@@ -294,12 +542,17 @@ def modify_word(id_w, proper, forbid_all, forbidden):
             newForbidden = Forbidden(word_id = id_w, publication_id = fpub)
             db_session.add(newForbidden)
     db_session.commit()
+    bump_generation()
+    # Forbidden words change the rankings
+    rebuild_top_words()
     return "Updated."
 
 def modify_publication(id_p, name, url):
     '''Change the information of a publication.'''
     db_session.query(Publication).filter(Publication.id == id_p).\
             update({"name":name, "url":url})
+    bump_generation()
+    sync_analytics_later()
 
 # Create functions
 #------------------------------
@@ -310,6 +563,8 @@ def follow_publication(name, url):
     new_publication = Publication(name=name, url=url)
     db_session.add(new_publication)
     db_session.commit()
+    bump_generation()
+    sync_analytics_later()
     return "Following publication {} at {} ".format(name, url)
 
 # Delete
@@ -328,15 +583,54 @@ def delete_stuff(q):
 
 def delete_publication(p_id):
     '''Delete ONE publication from the database
-    Must delete teh dependents frontpage & wordcounts.'''
-    return delete_stuff(db_session.query(Publication).\
-                        filter(Publication.id == p_id))
+    Must delete teh dependents frontpage & wordcounts,
+    and its rollups.'''
+    with transaction() as connection:
+        forget_publication(connection, p_id)
+    result = delete_stuff(db_session.query(Publication).\
+                          filter(Publication.id == p_id))
+    bump_generation()
+    rebuild_top_words()
+    return result
 
 def delete_front_page(fp_id):
     '''Delete ONE front page from the database.
-    Must delete the dependent wordcounts.'''
-    return delete_stuff(db_session.query(FrontPage).\
-                        filter(FrontPage.id == fp_id))
+    Must delete the dependent wordcounts, and update the rollup
+    of its day.'''
+    with transaction() as connection:
+        days = days_of_front_pages(connection, [fp_id])
+    result = delete_stuff(db_session.query(FrontPage).\
+                          filter(FrontPage.id == fp_id))
+    with transaction() as connection:
+        refresh_days(connection, days)
+    bump_generation()
+    rebuild_top_words()
+    return result
+
+def delete_front_pages_at(dated):
+    '''Delete the front pages of the given (publication id, time
+    of publication) pairs, with their wordcounts, and update the
+    rollups of their days, e.g. before they are analyzed again.
+    Return the number of deleted front pages.'''
+    if not dated:
+        return 0
+    with transaction() as connection:
+        ids = [fp_id for fp_id, in connection.execute(
+            select([FrontPage.id]).\
+            where(tuple_(FrontPage.publication_id,
+                         FrontPage.time_of_publication).in_(list(dated))))]
+        if not ids:
+            return 0
+        days = days_of_front_pages(connection, ids)
+        # Bounding the word counts by date only reads their partitions
+        connection.execute(WordCount.__table__.delete().\
+                           where(and_(WordCount.frontpage_id.in_(ids),
+                                      WordCount.time_of_publication.in_(
+                                          set(t for _, t in dated)))))
+        connection.execute(FrontPage.__table__.delete().\
+                           where(FrontPage.id.in_(ids)))
+        refresh_days(connection, days)
+    return len(ids)
 
 # Utilities (should move soon)
 #------------------------------
@@ -348,7 +642,8 @@ def boot_sql_alchemy():
                config.DB_PASSWORD,
                config.DB_HOST,
                config.DB_PORT,
-               config.DB_NAME)
+               config.DB_NAME,
+               analytics_read_uri())
     
 def init_db():
     '''Create the database.'''
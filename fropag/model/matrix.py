@@ -0,0 +1,239 @@
+'''In-memory matrix of the word counts, for the charts.
+
+The daily rollup is loaded once in NumPy arrays : a sparse
+matrix, in coordinate form, of the counts of each word (columns)
+for each publication and day (rows), sorted by word, with the
+words, the forbidden words and the number of front pages of each
+publication and day alongside. Tops, frequencies and histories
+are then computed by vectorized operations, in the web process,
+with the same results as the functions of model.core.
+The matrix is loaded again, in a thread, when the generation of the
+data changed.'''
+# -*- coding: utf-8 -*-
+import copy
+import datetime
+import decimal
+import logging
+import threading
+import time
+
+import config
+from database import read_session
+from model.publication import Publication, Word, Forbidden
+from model.publication import DailyWordCount, DailyFrontPageCount
+from model.core import bucket_history, get_generation, BUCKETS, DAY
+
+try:
+    import numpy
+except ImportError:
+    # NumPy is optional : the charts are then read from the database.
+    numpy = None
+
+_log = logging.getLogger('fropag.matrix')
+
+class CountMatrix(object):
+    """Word counts by publication and day, and the answers of
+    the charts computed from them.
+
+    >>> day = datetime.date(2014, 10, 17).toordinal()
+    >>> matrix = CountMatrix([(1, 'A')], [(1, 'vote', False), (2, 'Paris', True)],
+    ...                      [], [(1, 1, day, 3), (1, 2, day, 1)], [(1, day, 2)])
+    >>> matrix.all_tops()
+    {'propers': [('Paris', Decimal('0.50'))], 'commons': [('vote', Decimal('1.50'))], 'mindate': '17/10/2014', 'maxdate': '17/10/2014'}
+    """
+    def __init__(self, publications, words, forbidden, counts, front_pages):
+        '''Publications are (id, name), words (id, word, proper),
+        forbidden (word id, publication id or None), counts
+        (publication id, word id, day, count) and front_pages
+        (publication id, day, count), days being ordinals.'''
+        self.names = dict(publications)
+        self.ids = dict((name, p_id) for p_id, name in publications)
+        size = max([w[0] for w in words] + [0]) + 1
+        self.text = numpy.empty(size, dtype=object)
+        self.proper = numpy.zeros(size, dtype=bool)
+        self.ids_of_text = {}
+        for w_id, word, proper in words:
+            self.text[w_id] = word
+            self.proper[w_id] = proper
+            self.ids_of_text.setdefault(word, []).append(w_id)
+        # Rank of each word in alphabetical order, to break ties
+        order = sorted(range(size), key=lambda w_id: self.text[w_id] or '')
+        self.alphabetical = numpy.empty(size, dtype=numpy.int64)
+        self.alphabetical[order] = numpy.arange(size)
+
+        columns = numpy.array(counts, dtype=numpy.int64).reshape(-1, 4)
+        by_word = numpy.argsort(columns[:, 1], kind='stable')
+        self.publication, self.word, self.day, self.count = \
+            columns[by_word].T
+        # The counts of word w are from word_start[w] to word_start[w + 1]
+        self.word_start = numpy.searchsorted(self.word, numpy.arange(size + 1))
+
+        forbidden_all = numpy.zeros(size, dtype=bool)
+        forbidden_pairs = []
+        for w_id, p_id in forbidden:
+            if p_id is None:
+                forbidden_all[w_id] = True
+            else:
+                forbidden_pairs.append(p_id * size + w_id)
+        self.allowed = ~forbidden_all[self.word] & \
+                       ~numpy.isin(self.publication * size + self.word,
+                                   forbidden_pairs)
+
+        front_pages = numpy.array(front_pages, dtype=numpy.int64).reshape(-1, 3)
+        self.fp_publication, self.fp_day, self.fp_count = front_pages.T
+        self.answers = {}
+
+    def answer(self, key, compute):
+        '''Answers are computed once, and copied for
+        each caller, who may modify them.'''
+        if key not in self.answers:
+            self.answers[key] = compute()
+        return copy.deepcopy(self.answers[key])
+
+    def ranking(self, selected, nmb_return, front_pages=None):
+        '''The nmb_return first propers and commons of the selected
+        counts, by sum, or by frequency if the number of front pages
+        is given, with the datespan of the selected counts if there
+        are commons, as separate_propers_and_commons gives them.'''
+        sums = numpy.bincount(self.word[selected],
+                              weights=self.count[selected],
+                              minlength=len(self.text)).astype(numpy.int64)
+        present = numpy.bincount(self.word[selected],
+                                 minlength=len(self.text)) > 0
+        if front_pages is None:
+            values = sums
+        elif front_pages == 0:
+            values = numpy.zeros_like(sums)
+        else:
+            # Hundredths, rounded half up, as the Numeric(10, 2) of SQL
+            values = (200 * sums + front_pages) // (2 * front_pages)
+        results = {}
+        for kind, proper in (('propers', True), ('commons', False)):
+            candidates = numpy.nonzero(present & (self.proper == proper))[0]
+            order = numpy.lexsort((self.alphabetical[candidates],
+                                   -values[candidates]))
+            results[kind] = [(self.text[w_id], self.value(values[w_id],
+                                                          front_pages))
+                             for w_id in candidates[order[:nmb_return]]]
+        if results['commons']:
+            days = self.day[selected]
+            results['mindate'] = self.date(days.min()).strftime('%d/%m/%Y')
+            results['maxdate'] = self.date(days.max()).strftime('%d/%m/%Y')
+        return results
+
+    @staticmethod
+    def value(value, front_pages):
+        '''A sum, or a frequency from its hundredths.'''
+        if front_pages is None:
+            return int(value)
+        return decimal.Decimal(int(value)).scaleb(-2)
+
+    @staticmethod
+    def date(ordinal):
+        return datetime.date.fromordinal(int(ordinal))
+
+    def front_pages_of(self, p_id):
+        return int(self.fp_count[self.fp_publication == p_id].sum())
+
+    def all_tops(self):
+        '''Same as core.get_all_tops.'''
+        return self.answer(('tops',), lambda: self.ranking(
+            self.allowed, 10, int(self.fp_count.sum())))
+
+    def most_used(self, name):
+        '''Same as core.get_publication_most_used.'''
+        p_id = self.ids.get(name)
+        return self.answer(('most_used', name), lambda: self.ranking(
+            self.allowed & (self.publication == p_id), 100))
+
+    def frequency(self, names, nmb_return=10):
+        '''Same as core.get_publication_frequency.'''
+        return dict((name, self.answer(('frequency', name, nmb_return),
+                                       lambda: self.ranking(
+            self.allowed & (self.publication == self.ids[name]), nmb_return,
+            self.front_pages_of(self.ids[name]))))
+                    for name in names if name in self.ids)
+
+    def history(self, word, start=None, end=None, bucket=DAY, columnar=False):
+        '''Same as core.get_history_for.'''
+        if bucket not in BUCKETS:
+            raise ValueError("Unknown bucket {}.".format(bucket))
+        if len(self.fp_day) and (start is None or end is None):
+            start = start or self.date(self.fp_day.min())
+            end = end or self.date(self.fp_day.max())
+        slices = [slice(self.word_start[w_id], self.word_start[w_id + 1])
+                  for w_id in self.ids_of_text.get(word, [])]
+        day_counts = []
+        if slices and start is not None and end is not None:
+            publication = numpy.concatenate([self.publication[s]
+                                             for s in slices])
+            day = numpy.concatenate([self.day[s] for s in slices])
+            count = numpy.concatenate([self.count[s] for s in slices])
+            in_range = (day >= start.toordinal()) & (day <= end.toordinal())
+            day_counts = [(self.names[p_id], self.date(d), int(c))
+                          for p_id, d, c in zip(publication[in_range],
+                                                day[in_range],
+                                                count[in_range])]
+        return bucket_history(day_counts, list(self.names.values()),
+                              start, end, bucket, columnar)
+
+def load_matrix():
+    '''Load the word counts of the daily rollup in a matrix.'''
+    time0 = time.time()
+    matrix = CountMatrix(
+        read_session.query(Publication.id, Publication.name).all(),
+        read_session.query(Word.id, Word.word, Word.proper).all(),
+        read_session.query(Forbidden.word_id, Forbidden.publication_id).all(),
+        [(p_id, w_id, day.toordinal(), count) for p_id, w_id, day, count in
+         read_session.query(DailyWordCount.publication_id,
+                            DailyWordCount.word_id,
+                            DailyWordCount.day,
+                            DailyWordCount.count)],
+        [(p_id, day.toordinal(), count) for p_id, day, count in
+         read_session.query(DailyFrontPageCount.publication_id,
+                            DailyFrontPageCount.day,
+                            DailyFrontPageCount.count)])
+    _log.info('Loaded %d word counts in %.1f secs.',
+              len(matrix.count), time.time() - time0)
+    return matrix
+
+_matrix = None
+_version = None
+_checked = 0
+# Held by the thread checking the generation, and loading a matrix
+_loading = threading.Lock()
+
+def current_matrix():
+    '''The matrix of the word counts ; None if there is no matrix,
+    no NumPy, or until the first one is loaded. Every
+    MATRIX_CHECK_INTERVAL seconds, a thread checks whether the data
+    changed, and loads a new matrix if it did : requests never wait
+    for it, they get the previous matrix meanwhile.'''
+    if not config.COUNT_MATRIX or numpy is None:
+        return None
+    if time.time() - _checked > config.MATRIX_CHECK_INTERVAL and \
+       _loading.acquire(blocking=False):
+        threading.Thread(target=refresh_matrix, daemon=True).start()
+    return _matrix
+
+def matrix_is_current(generation):
+    '''Whether the answers of current_matrix are computed from this
+    generation of the data. They are if there is no matrix, the
+    charts being then read from the database ; they are not while
+    a new matrix is not yet loaded.'''
+    return current_matrix() is None or _version == generation
+
+def refresh_matrix():
+    '''Load a new matrix if the generation of the data changed,
+    and replace the current one with it.'''
+    global _matrix, _version, _checked
+    try:
+        version = get_generation()
+        if _matrix is None or version != _version:
+            _matrix, _version = load_matrix(), version
+        _checked = time.time()
+    except Exception as exception:
+        _log.error('Could not load the word counts : %s', exception)
+    finally:
+        read_session.remove()
+        _loading.release()
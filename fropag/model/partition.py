@@ -0,0 +1,203 @@
+'''Monthly partitions of the word counts.
+
+With PostgreSQL, the wordcount table is partitioned by range
+on its time_of_publication, copied from the front page of each
+row : there is one partition per month, named wordcount_YYYY_MM,
+created before the first word counts of its month are saved.
+A query bounded in time, forgetting old months, or vacuuming,
+then only touches the partitions of the months concerned.
+partition_word_counts moves the word counts of a database created
+before the partitions into them.'''
+# -*- coding: utf-8 -*-
+import datetime
+import logging
+
+from sqlalchemy import text
+
+from database import get_engine
+from model.publication import WordCount
+from model.publication import DailyWordCount, DailyFrontPageCount
+from model.rollup import transaction
+from model.core import bucket_start, next_bucket, MONTH, rebuild_top_words
+
+_log = logging.getLogger('fropag.partition')
+
+# Where the word counts wait while they are moved into partitions.
+UNPARTITIONED = 'wordcount_unpartitioned'
+
+# Months whose partition this process knows to exist.
+_partitions = set()
+
+def forget_partitions():
+    '''Empty the cache of partitions, e.g. when the
+    wordcount table was dropped.'''
+    _partitions.clear()
+
+def partition_name(month):
+    """Name of the partition of the month starting on that day.
+
+    >>> partition_name(datetime.date(2014, 10, 1))
+    'wordcount_2014_10'
+    """
+    return 'wordcount_{:%Y_%m}'.format(month)
+
+def month_of_partition(name):
+    """First day of the month of a partition ; None if the name
+    is not the one of a partition.
+
+    >>> month_of_partition('wordcount_2014_10')
+    datetime.date(2014, 10, 1)
+    >>> month_of_partition('wordcount_unpartitioned') is None
+    True
+    """
+    try:
+        return datetime.datetime.strptime(name, 'wordcount_%Y_%m').date()
+    except ValueError:
+        return None
+
+def can_partition(engine):
+    '''Only PostgreSQL partitions tables.'''
+    return engine.dialect.name == 'postgresql'
+
+def is_partitioned(connection, table='wordcount'):
+    '''True if the table exists and is partitioned.'''
+    return connection.execute(text(
+        "SELECT relkind FROM pg_class WHERE oid = to_regclass(:table)"),
+        table=table).scalar() == 'p'
+
+def table_exists(connection, table):
+    '''True if there is a table with this name.'''
+    return connection.execute(text("SELECT to_regclass(:table)"),
+                              table=table).scalar() is not None
+
+def create_partition(connection, month):
+    '''Create the partition of a month, unless it exists.'''
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS {} PARTITION OF wordcount "
+        "FOR VALUES FROM ('{}') TO ('{}')".format(
+            partition_name(month), month, next_bucket(month, MONTH))))
+
+def ensure_partitions(times):
+    '''Create the missing partitions of the months of the given
+    times, before word counts of those months are saved. They are
+    created in their own short transaction, not to lock the
+    wordcount table while the word counts are written.'''
+    engine = get_engine()
+    if not can_partition(engine):
+        return
+    months = set(bucket_start(time.date(), MONTH) for time in times)
+    months -= _partitions
+    if not months:
+        return
+    with transaction() as connection:
+        for month in sorted(months):
+            create_partition(connection, month)
+    _partitions.update(months)
+
+def existing_partitions(connection):
+    '''First day of the month of every partition of wordcount.'''
+    names = connection.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'wordcount'::regclass"))
+    return sorted(month for month in (month_of_partition(name)
+                                      for name, in names)
+                  if month is not None)
+
+def set_aside_unpartitioned(connection):
+    '''Rename the unpartitioned wordcount table, its sequence
+    and its indexes, and create the partitioned one in its place,
+    its ids following the ones already given.'''
+    connection.execute(text("ALTER TABLE wordcount RENAME TO {}".\
+                            format(UNPARTITIONED)))
+    connection.execute(text("ALTER SEQUENCE wordcount_id_seq RENAME TO {}_id_seq".\
+                            format(UNPARTITIONED)))
+    for index in ('wordcount_pkey', 'ix_wordcount_frontpage_id',
+                  'ix_wordcount_word_id'):
+        connection.execute(text("ALTER INDEX IF EXISTS {} RENAME TO {}".\
+                                format(index, index.replace(
+                                    'wordcount', UNPARTITIONED, 1))))
+    WordCount.__table__.create(connection)
+    connection.execute(text(
+        "SELECT setval('wordcount_id_seq', "
+        "(SELECT coalesce(max(id), 0) + 1 FROM {}), false)".\
+        format(UNPARTITIONED)))
+
+def partition_word_counts():
+    '''Move the word counts of a wordcount table created before the
+    partitions into a partitioned one, a month at a time, each month
+    in its own transaction : if it stops, running it again goes on
+    where it stopped.'''
+    engine = get_engine()
+    if not can_partition(engine):
+        return "Word counts can only be partitioned with PostgreSQL."
+    with transaction() as connection:
+        if not table_exists(connection, UNPARTITIONED):
+            if is_partitioned(connection):
+                return "Word counts are already partitioned."
+            set_aside_unpartitioned(connection)
+            _log.info('Created the partitioned wordcount table.')
+    with transaction() as connection:
+        months = [bucket_start(month.date(), MONTH) for month, in
+                  connection.execute(text(
+                      "SELECT DISTINCT date_trunc('month', f.time_of_publication) "
+                      "FROM {} c JOIN frontpage f ON f.id = c.frontpage_id "
+                      "WHERE f.time_of_publication IS NOT NULL".\
+                      format(UNPARTITIONED)))]
+    moved = 0
+    for month in sorted(months):
+        ensure_partitions([datetime.datetime.combine(month, datetime.time())])
+        of_the_month = ("FROM {} c USING frontpage f "
+                        "WHERE f.id = c.frontpage_id "
+                        "AND f.time_of_publication >= :start "
+                        "AND f.time_of_publication < :end").\
+                       format(UNPARTITIONED)
+        bounds = {'start' : month, 'end' : next_bucket(month, MONTH)}
+        with transaction() as connection:
+            moved += connection.execute(text(
+                "INSERT INTO wordcount (id, frontpage_id, word_id, count, "
+                "time_of_publication) "
+                "SELECT c.id, c.frontpage_id, c.word_id, c.count, "
+                "f.time_of_publication FROM {} c JOIN frontpage f "
+                "ON f.id = c.frontpage_id "
+                "WHERE f.time_of_publication >= :start "
+                "AND f.time_of_publication < :end".format(UNPARTITIONED)),
+                **bounds).rowcount
+            connection.execute(text("DELETE " + of_the_month), **bounds)
+        _log.info('Moved the word counts of %s.', partition_name(month))
+    with transaction() as connection:
+        left = connection.execute(text("SELECT count(*) FROM {}".\
+                                       format(UNPARTITIONED))).scalar()
+        if not left:
+            connection.execute(text("DROP TABLE {}".format(UNPARTITIONED)))
+    result = "Moved {} word counts into {} monthly partitions.".\
+             format(moved, len(months))
+    if left:
+        result += " {} word counts without a date are left in {}.".\
+                  format(left, UNPARTITIONED)
+    return result
+
+def forget_months_before(day):
+    '''Delete everything saved before the month of day : the
+    partitions of the word counts of the previous months are
+    dropped, which is immediate and leaves nothing to vacuum,
+    then their front pages and rollups are deleted.'''
+    engine = get_engine()
+    if not can_partition(engine):
+        return "Only partitioned word counts can be forgotten by month."
+    first_kept = bucket_start(day, MONTH)
+    with transaction() as connection:
+        dropped = [month for month in existing_partitions(connection)
+                   if month < first_kept]
+        for month in dropped:
+            connection.execute(text("DROP TABLE {}".\
+                                    format(partition_name(month))))
+        for table in (DailyWordCount.__table__, DailyFrontPageCount.__table__):
+            connection.execute(table.delete().where(table.c.day < first_kept))
+        front_pages = connection.execute(text(
+            "DELETE FROM frontpage WHERE time_of_publication < :start"),
+            start=first_kept).rowcount
+    _partitions.difference_update(dropped)
+    rebuild_top_words()
+    return "Forgot {} front pages and {} monthly partitions before {}.".\
+           format(front_pages, len(dropped), first_kept)
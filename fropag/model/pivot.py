@@ -0,0 +1,60 @@
+'''Pivot of query results : (row, column, value) triples, e.g.
+(date, publication, count), become a table with one line per row
+and one column per column, built in a single pass over the triples.'''
+# -*- coding: utf-8 -*-
+
+def index_of(keys):
+    '''Position of every key, in sorted order.'''
+    return dict((key, position) for position, key in enumerate(keys))
+
+def pivot(elems, by_column=False):
+    """Given a list of (row, column, value) triples, return the
+    sorted rows, the sorted columns, and the matrix of the values
+    (a list of lists), 0 where a row has no value for a column.
+    Values given twice for the same row and column are summed.
+    The matrix has a list for each row, or, if by_column is
+    True, for each column.
+
+    >>> pivot([('d2', 'b', 3), ('d1', 'a', 1), ('d2', 'a', 2)])
+    (['d1', 'd2'], ['a', 'b'], [[1, 0], [2, 3]])
+    >>> pivot([('d2', 'b', 3), ('d1', 'a', 1), ('d2', 'a', 2)], by_column=True)
+    (['d1', 'd2'], ['a', 'b'], [[1, 2], [0, 3]])
+    """
+    rows = {}
+    columns = {}
+    for row, column, value in elems:
+        rows[row] = columns[column] = None
+    rows = sorted(rows)
+    columns = sorted(columns)
+    row_index = index_of(rows)
+    column_index = index_of(columns)
+    if by_column:
+        matrix = [[0] * len(rows) for _ in columns]
+        for row, column, value in elems:
+            matrix[column_index[column]][row_index[row]] += value
+    else:
+        matrix = [[0] * len(columns) for _ in rows]
+        for row, column, value in elems:
+            matrix[row_index[row]][column_index[column]] += value
+    return rows, columns, matrix
+
+def to_rows(elems, first_column_name):
+    """Pivot triples into a list of lines : a legend line, with
+    first_column_name then the columns, and a line for each row.
+
+    >>> to_rows([('d1', 'a', 1), ('d2', 'b', 3)], 'date')
+    [['date', 'a', 'b'], ['d1', 1, 0], ['d2', 0, 3]]
+    """
+    rows, columns, matrix = pivot(elems)
+    return [[first_column_name] + columns] + \
+           [[row] + values for row, values in zip(rows, matrix)]
+
+def to_columns(elems, rows_name):
+    """Pivot triples into columns : the rows under rows_name,
+    and the values of each column under series.
+
+    >>> to_columns([('d1', 'a', 1), ('d2', 'b', 3)], 'dates')
+    {'dates': ['d1', 'd2'], 'series': {'a': [1, 0], 'b': [0, 3]}}
+    """
+    rows, columns, matrix = pivot(elems, by_column=True)
+    return {rows_name: rows, 'series': dict(zip(columns, matrix))}
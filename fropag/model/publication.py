@@ -1,8 +1,10 @@
 '''Model of Fropag, containing the classes we deal with.'''
 # -*- coding: utf-8 -*-
-from sqlalchemy import Column, ForeignKey, Integer, String, Float, Enum
-from sqlalchemy import DateTime, Boolean, UniqueConstraint
+from sqlalchemy import Column, ForeignKey, Integer, String, Float, Enum, Text
+from sqlalchemy import Date, DateTime, Boolean, UniqueConstraint, Index
+from sqlalchemy import PrimaryKeyConstraint
 from sqlalchemy.orm import relationship
+from sqlalchemy.ext.compiler import compiles
 import datetime
 
 from database import Base
@@ -15,7 +17,7 @@ class Word(Base):
     id = Column(Integer, primary_key=True)
     word = Column(String, index=True)
     proper = Column(Boolean)
-    UniqueConstraint('word', 'proper')
+    __table_args__ = (UniqueConstraint('word', 'proper'),)
 
 class Forbidden(Base):
     __tablename__ = "forbidden"
@@ -24,6 +26,8 @@ class Forbidden(Base):
                      nullable=False)
     # Can and SHOULD be null for general interdictions
     publication_id = Column(Integer, ForeignKey("publication.id"))
+    __table_args__ = (Index('ix_forbidden_word_publication',
+                            'word_id', 'publication_id'),)
 
 class Publication(Base):
     """A newspaper, magazine or any kind of periodic publication
@@ -70,10 +74,68 @@ class FrontPage(Base):
 
 class WordCount(Base):
     """WordCount link FrontPages and Words. They allow us to know
-    how many time a word was counted on one frontpage."""
+    how many time a word was counted on one frontpage.
+    With PostgreSQL, they are partitioned by month (see
+    model.partition), so they carry the date of their frontpage."""
     __tablename__ = "wordcount"
     id = Column(Integer, primary_key=True)
+    # Copied from the frontpage : the key of the partitions
+    time_of_publication = Column(DateTime, nullable=False)
     frontpage_id = Column(Integer, ForeignKey("frontpage.id"), nullable=False,
                           index=True)
     word_id = Column(Integer, ForeignKey("word.id"), nullable=False, index=True)
     count = Column(Integer)
+    __table_args__ = {'postgresql_partition_by' :
+                      'RANGE (time_of_publication)',
+                      'info' : {'partition_key' : 'time_of_publication'}}
+
+@compiles(PrimaryKeyConstraint, 'postgresql')
+def primary_key_with_partition_key(constraint, compiler, **kw):
+    '''PostgreSQL wants the primary key of a partitioned table
+    to include its partition key : (id, time_of_publication) for
+    the word counts. Other databases keep the id alone.'''
+    partition_key = constraint.table.info.get('partition_key')
+    if partition_key is None:
+        return compiler.visit_primary_key_constraint(constraint, **kw)
+    columns = [column.name for column in constraint.columns] + [partition_key]
+    return 'PRIMARY KEY ({})'.format(
+        ', '.join(compiler.preparer.quote(name) for name in columns))
+
+class DailyWordCount(Base):
+    """Sum of the counts of a word on the front pages of a
+    publication, for one day. This rollup is kept up to date
+    when front pages are saved or deleted, so counting words
+    does not have to go through every WordCount."""
+    __tablename__ = "daily_wordcount"
+    publication_id = Column(Integer, ForeignKey("publication.id"),
+                            primary_key=True)
+    word_id = Column(Integer, ForeignKey("word.id"), primary_key=True)
+    day = Column(Date, primary_key=True, index=True)
+    count = Column(Integer)
+    # The history of a word reads a range of days for this word only
+    __table_args__ = (Index('ix_daily_wordcount_word_day', 'word_id', 'day'),)
+
+class DailyFrontPageCount(Base):
+    """Number of front pages read for a publication on one day."""
+    __tablename__ = "daily_frontpage"
+    publication_id = Column(Integer, ForeignKey("publication.id"),
+                            primary_key=True)
+    day = Column(Date, primary_key=True, index=True)
+    count = Column(Integer)
+
+class TopWords(Base):
+    """A ranking of words, computed once after each reading
+    instead of at every view. Content is the ranking in JSON ;
+    publication_id is 0 for the rankings of every publication."""
+    __tablename__ = "top_words"
+    kind = Column(String, primary_key=True)
+    publication_id = Column(Integer, primary_key=True, autoincrement=False)
+    content = Column(Text)
+    computed = Column(DateTime, default=datetime.datetime.utcnow)
+
+class DataGeneration(Base):
+    """A single counter, increased whenever the data shown
+    changes, so cached answers computed before are not used."""
+    __tablename__ = "data_generation"
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    generation = Column(Integer, nullable=False)
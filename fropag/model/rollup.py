@@ -0,0 +1,111 @@
+'''Daily rollups of the word counts.
+
+DailyWordCount and DailyFrontPageCount sum the wordcount and
+frontpage tables by publication and day. When front pages are
+saved or deleted, only the days they belong to are computed
+again ; rebuild_rollups computes everything again.'''
+# -*- coding: utf-8 -*-
+import contextlib
+import datetime
+
+from sqlalchemy import func, select, literal, and_, Date
+from database import get_engine
+from model.publication import FrontPage, WordCount
+from model.publication import DailyWordCount, DailyFrontPageCount
+
+@contextlib.contextmanager
+def transaction(isolation_level="READ COMMITTED"):
+    '''Give a connection in a transaction, committed at the end
+    of the block, or rolled back if it raised. The engine being
+    in autocommit mode, the connection gets its own isolation level.'''
+    with get_engine().connect() as autocommit_connection:
+        connection = autocommit_connection.\
+                     execution_options(isolation_level=isolation_level)
+        with connection.begin():
+            yield connection
+
+def days_of_front_pages(connection, ids):
+    '''(publication id, day) of the front pages with the given ids.'''
+    if not ids:
+        return set()
+    query = select([FrontPage.publication_id,
+                    FrontPage.time_of_publication]).\
+            where(FrontPage.id.in_(list(ids)))
+    return set((p_id, time.date()) for p_id, time in connection.execute(query))
+
+def refresh_days(connection, days):
+    '''Compute again the rollups of the given (publication id, day).
+    With PostgreSQL, each day is locked until the end of the
+    transaction, so that two saves of the same day do not delete
+    and insert its rollups at the same time.'''
+    words = DailyWordCount.__table__
+    front_pages = DailyFrontPageCount.__table__
+    # Always in the same order, so concurrent refreshes cannot deadlock.
+    for publication_id, day in sorted(days):
+        if connection.dialect.name == 'postgresql':
+            connection.execute(select([func.pg_advisory_xact_lock(
+                publication_id, day.toordinal())]))
+        start = datetime.datetime.combine(day, datetime.time())
+        end = start + datetime.timedelta(days=1)
+        of_the_day = and_(FrontPage.publication_id == publication_id,
+                          FrontPage.time_of_publication >= start,
+                          FrontPage.time_of_publication < end)
+        # Bounding the word counts too only reads the partition of the day
+        counts_of_the_day = and_(of_the_day,
+                                 WordCount.time_of_publication >= start,
+                                 WordCount.time_of_publication < end)
+        for table in (words, front_pages):
+            connection.execute(table.delete().\
+                               where(and_(table.c.publication_id ==
+                                          publication_id,
+                                          table.c.day == day)))
+        connection.execute(words.insert().from_select(
+            ['publication_id', 'word_id', 'day', 'count'],
+            select([FrontPage.publication_id, WordCount.word_id,
+                    literal(day, Date), func.sum(WordCount.count)]).\
+            select_from(WordCount.__table__.join(FrontPage.__table__)).\
+            where(counts_of_the_day).\
+            group_by(FrontPage.publication_id, WordCount.word_id)))
+        connection.execute(front_pages.insert().from_select(
+            ['publication_id', 'day', 'count'],
+            select([FrontPage.publication_id, literal(day, Date),
+                    func.count(FrontPage.id)]).\
+            where(of_the_day).\
+            group_by(FrontPage.publication_id)))
+
+def refresh_front_pages(connection, ids):
+    '''Update the rollups once the front pages with
+    the given ids were saved.'''
+    refresh_days(connection, days_of_front_pages(connection, ids))
+
+def forget_publication(connection, p_id):
+    '''Remove the rollups of a publication.'''
+    for table in (DailyWordCount.__table__, DailyFrontPageCount.__table__):
+        connection.execute(table.delete().where(table.c.publication_id == p_id))
+
+def rebuild_rollups():
+    '''Compute every rollup again from the wordcount
+    and frontpage tables.'''
+    words = DailyWordCount.__table__
+    front_pages = DailyFrontPageCount.__table__
+    day = func.date(FrontPage.time_of_publication)
+    with transaction() as connection:
+        connection.execute(words.delete())
+        connection.execute(front_pages.delete())
+        connection.execute(words.insert().from_select(
+            ['publication_id', 'word_id', 'day', 'count'],
+            select([FrontPage.publication_id, WordCount.word_id,
+                    day, func.sum(WordCount.count)]).\
+            select_from(WordCount.__table__.join(FrontPage.__table__)).\
+            group_by(FrontPage.publication_id, WordCount.word_id, day)))
+        connection.execute(front_pages.insert().from_select(
+            ['publication_id', 'day', 'count'],
+            select([FrontPage.publication_id, day,
+                    func.count(FrontPage.id)]).\
+            group_by(FrontPage.publication_id, day)))
+        number_of_days = connection.execute(
+            select([func.count()]).select_from(front_pages)).scalar()
+        number_of_counts = connection.execute(
+            select([func.count()]).select_from(words)).scalar()
+    return "Rebuilt rollups : {} word counts for {} publication days.".\
+           format(number_of_counts, number_of_days)
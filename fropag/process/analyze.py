@@ -21,7 +21,10 @@ from nltk.corpus import PlaintextCorpusReader
 from nltk import Text, word_tokenize
 from nltk.tag.stanford import POSTagger
 from collections import Counter
+import config
 from model.publication import Publication
+from process import tagger
+from process.lexicon import Lexicon, tag_sentences
 
 class EmptyContentException(Exception):
     '''This exception should be called if an empty frontpage
@@ -40,12 +43,47 @@ postagging_to_remove = ['PUNC','DET', 'P', 'C', 'CC'
                        , 'PRO', 'CLS', 'PROREL', 'CS']
 proper_nouns = 'NPP'
 
-def tag_text(text):
-    """Analyze a text to be able to identify unwanted words."""
+def stanford_tag(sentences):
+    """Tag lists of tokens with the Stanford tagger.
+    If a tagger service is running (see the tagger module),
+    its warm taggers are used. Otherwise, a new tagger is launched,
+    once for all the sentences."""
+    if tagger.is_running():
+        return tagger.tag_batch(sentences)
+    if not sentences:
+        return []
     posTagger = POSTagger('stanford/french.tagger'
                         ,'stanford/stanford-postagger.jar'
                         ,encoding='utf-8')
-    return posTagger.tag(text.tokens)   
+    return posTagger.tag_sents(sentences)
+
+def tag_text(text):
+    """Analyze a text to be able to identify unwanted words."""
+    return tag_texts([text])[0]
+
+def tag_texts(texts):
+    """Analyze several texts at once. With a running tagger
+    service, they are all sent in a single request.
+    With the lexicon backend, only the tokens the lexicon cannot
+    tag are sent to the Stanford tagger."""
+    sentences = [text.tokens for text in texts]
+    if config.TAGGER_BACKEND == 'lexicon':
+        return tag_sentences(get_lexicon(), sentences, stanford_tag)
+    return stanford_tag(sentences)
+
+_lexicon = None
+
+def get_lexicon():
+    """Load the lexicon the first time it is needed."""
+    global _lexicon
+    if _lexicon is None:
+        _lexicon = Lexicon.load(config.LEXICON_PATH)
+    return _lexicon
+
+def save_lexicon():
+    """Save what the lexicon learned, if it was used."""
+    if _lexicon is not None:
+        _lexicon.save(config.LEXICON_PATH)
 
 def trim_unwanted_tags(tagged):
     """Remove any words corresponding to tags we do not want
@@ -68,10 +106,34 @@ def frontpage_to_text(text):
 def get_stats(text):
     nltk_text = frontpage_to_text(text)
     tagged = tag_text(nltk_text)
+    return stats_from_tagged(tagged)
+
+def get_stats_batch(texts):
+    """Same as get_stats, for several front pages whose
+    tokens are tagged all together. Return a list with the
+    stats of each text, or None when a text has no content."""
+    tagged_texts = tag_texts([frontpage_to_text(text) for text in texts])
+    results = []
+    for tagged in tagged_texts:
+        try:
+            results.append(stats_from_tagged(tagged))
+        except EmptyContentException:
+            results.append(None)
+    return results
+
+def stats_from_tagged(tagged):
+    """Separate proper nouns and other words of a tagged text,
+    count them and compute the lexical richness.
+
+    >>> stats = stats_from_tagged([('Paris', 'NPP'), ('vote', 'V'),
+    ...                            ('le', 'DET'), ('Vote', 'V')])
+    >>> stats[0], stats[1], stats[2]
+    (Counter({'Paris': 1}), Counter({'vote': 2}), 0.5)
+    """
     filtered = trim_unwanted_tags(tagged)
     proper = [w[0].capitalize() for w in filtered if w[1] == proper_nouns]
     others = [w[0].lower() for w in filtered if w[1] != proper_nouns]
-    if len(others) is None:
+    if len(others) == 0:
         raise EmptyContentException("No content in this frontpage.")
     return (to_counter(proper), to_counter(others),
             get_lexical_richness(others))
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""This module keeps every version of every front page ever read.
+
+The corpus directory is an append-only archive :
+- corpus/objects holds the snapshots, gzipped, named after the
+  SHA-1 of their content, so identical versions are stored once ;
+  the fingerprints of a snapshot are stored next to it ;
+- corpus/index holds, for each front page, the list of its
+  snapshots, one "timestamp<TAB>hash" line per reading, in the
+  order they were read, so the latest is the last line. A reading
+  only gets its line once its front page was saved in the database."""
+
+import datetime
+import gzip
+import hashlib
+import os
+import urllib.parse
+
+ARCHIVE_DIR = "corpus"
+SNAPSHOT_SUFFIX = ".html.gz"
+INDEX_SUFFIX = ".index"
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+def publication_key(url):
+    """Name under which the snapshots of a front page are indexed.
+
+    >>> publication_key("http://www.lemonde.fr/international/")
+    'www.lemonde.fr%2Finternational%2F'
+    """
+    return urllib.parse.quote(url.split("://", 1)[-1], safe='')
+
+def object_path(digest, suffix=SNAPSHOT_SUFFIX):
+    '''Path of the file for the snapshot with this hash.'''
+    return os.path.join(ARCHIVE_DIR, "objects", digest[:2], digest + suffix)
+
+def index_path(url, suffix=INDEX_SUFFIX):
+    '''Path of the index of the snapshots of a front page.'''
+    return os.path.join(ARCHIVE_DIR, "index", publication_key(url) + suffix)
+
+def write_atomically(dest, content, mode='wb'):
+    '''Write a file through a temporary one, so a reader
+    never sees it half-written.'''
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    temporary = '{}.{}.tmp'.format(dest, os.getpid())
+    with open(temporary, mode) as temporary_file:
+        temporary_file.write(content)
+    os.replace(temporary, dest)
+
+def timestamp_now():
+    '''Current time, as precise as the index : front pages saved
+    with it can be found by the date of their snapshot.'''
+    return datetime.datetime.utcnow().replace(microsecond=0)
+
+def digest_of(html):
+    """Hash under which a version of a front page is stored.
+
+    >>> digest_of('<p>Un</p>')
+    'c99b904dd87da6b304043126b29c3dd4cb653337'
+    """
+    return hashlib.sha1(html.encode('utf-8')).hexdigest()
+
+def store_snapshot(html):
+    '''Store a version of a front page, without adding it to
+    the index of the front page. Return its hash.'''
+    digest = digest_of(html)
+    dest = object_path(digest)
+    if not os.path.exists(dest):
+        write_atomically(dest, gzip.compress(html.encode('utf-8')))
+    return digest
+
+def index_snapshot(url, digest, timestamp=None):
+    '''Record in the index of a front page that the stored
+    version with this hash was read at timestamp (now by default).'''
+    timestamp = timestamp or timestamp_now()
+    index = index_path(url)
+    os.makedirs(os.path.dirname(index), exist_ok=True)
+    with open(index, 'a') as index_file:
+        index_file.write('{}\t{}\n'.format(timestamp.strftime(TIMESTAMP_FORMAT),
+                                           digest))
+
+def save_snapshot(url, html, timestamp=None):
+    '''Archive a version of a front page. Return its hash.'''
+    digest = store_snapshot(html)
+    index_snapshot(url, digest, timestamp)
+    return digest
+
+def read_snapshot(digest):
+    '''Content of the snapshot with this hash.'''
+    return read_snapshot_file(object_path(digest))
+
+def read_snapshot_file(path):
+    '''Content of a saved front page, gzipped or not.'''
+    with open(path, 'rb') as snapshot_file:
+        raw = snapshot_file.read()
+    if path.endswith('.gz'):
+        raw = gzip.decompress(raw)
+    return raw.decode('utf-8')
+
+def parse_index_line(line):
+    """Read a line of an index.
+
+    >>> parse_index_line('2014-10-17T08:00:00\\tab12\\n')
+    (datetime.datetime(2014, 10, 17, 8, 0), 'ab12')
+    """
+    timestamp, digest = line.rstrip('\n').split('\t')
+    return (datetime.datetime.strptime(timestamp, TIMESTAMP_FORMAT), digest)
+
+def latest_snapshot(url):
+    '''Timestamp and hash of the last snapshot of a front page,
+    or None if it was never archived. Only the end of
+    the index is read.'''
+    index = index_path(url)
+    if not os.path.exists(index):
+        return None
+    with open(index, 'rb') as index_file:
+        index_file.seek(0, os.SEEK_END)
+        size = index_file.tell()
+        index_file.seek(max(0, size - 256))
+        lines = index_file.read().decode('utf-8').splitlines()
+    if not lines:
+        return None
+    return parse_index_line(lines[-1])
+
+def snapshots_of(url):
+    '''Every (timestamp, hash) archived for a front page.'''
+    index = index_path(url)
+    if not os.path.exists(index):
+        return []
+    with open(index, 'r') as index_file:
+        return [parse_index_line(line) for line in index_file if line.strip()]
+
+def archived_keys():
+    '''Key of every front page present in the archive.'''
+    index_dir = os.path.join(ARCHIVE_DIR, "index")
+    if not os.path.exists(index_dir):
+        return []
+    return sorted(urllib.parse.unquote(name[:-len(INDEX_SUFFIX)])
+                  for name in os.listdir(index_dir)
+                  if name.endswith(INDEX_SUFFIX))
+
+def all_digests():
+    '''Hash of every snapshot of the archive.'''
+    objects_dir = os.path.join(ARCHIVE_DIR, "objects")
+    digests = []
+    for root, dirs, files in os.walk(objects_dir):
+        digests.extend(name[:-len(SNAPSHOT_SUFFIX)] for name in files
+                       if name.endswith(SNAPSHOT_SUFFIX))
+    return sorted(digests)
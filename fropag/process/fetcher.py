@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""This module downloads many front pages at once.
+
+Every front page of a reading is requested concurrently, with a
+bounded number of requests in flight, connections kept alive and
+reused, a timeout for each request and a deadline for the whole
+reading. Each page is handed to a callback as soon as it arrives,
+so its analysis can start while the others are still downloading.
+As with access_page in the reader module, pages are only sent back
+if they changed since the last reading."""
+
+import asyncio
+import logging
+
+import aiohttp
+
+from process.reader import decode_page, UnreadablePageException
+from process.reader import conditional_headers, check_changed
+
+_log = logging.getLogger('fropag.fetcher')
+
+async def fetch_page(session, url, validators, slots, timeout):
+    '''Download one page and decode it, once one of the slots
+    (a semaphore) is free : the timeout only starts then. As with
+    access_page in the reader module, return the page and its
+    validators, the page being None if it did not change.'''
+    async with slots:
+        return await fetch_in_slot(session, url, validators, timeout)
+
+async def fetch_in_slot(session, url, validators, timeout):
+    '''fetch_page, once it has a slot.'''
+    headers = conditional_headers(validators)
+    try:
+        async with session.get(url, headers=headers,
+                               timeout=timeout) as response:
+            if response.status == 304:
+                return None, validators
+            if response.status >= 400:
+                raise UnreadablePageException(
+                    'Could not read the page at {}, got an HTTP error {}.'.\
+                    format(url, response.status))
+            raw = await response.read()
+            new_validators = check_changed(url, validators, raw,
+                                           response.headers.get('ETag'),
+                                           response.headers.get('Last-Modified'))
+            if new_validators is None:
+                return None, validators
+            return decode_page(url, raw, response.charset), new_validators
+    except asyncio.TimeoutError:
+        raise UnreadablePageException('Timeout when reading {}.'.format(url))
+    except aiohttp.ClientError as exc:
+        raise UnreadablePageException('Could not reach the page at {} : {}'.\
+                                      format(url, str(exc)))
+
+async def fetch_pages(to_fetch, on_page, on_error,
+                      max_in_flight, request_timeout, run_timeout):
+    '''to_fetch being a list of (key, url, validators), download
+    every url, calling on_page(key, page, validators) for each
+    page as soon as it arrives, and on_error(key, exception) for
+    each page that could not be read. Pages not read after
+    run_timeout seconds are abandoned.'''
+    loop = asyncio.get_event_loop()
+    # Requests wait for a slot before their timeout starts, so that
+    # waiting behind slow sites does not count as being slow.
+    slots = asyncio.Semaphore(max_in_flight)
+    connector = aiohttp.TCPConnector(limit=max_in_flight)
+    timeout = aiohttp.ClientTimeout(total=request_timeout)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        keys = {}
+        for key, url, validators in to_fetch:
+            keys[asyncio.ensure_future(fetch_page(session, url, validators,
+                                                  slots, timeout))] = key
+        pending = set(keys)
+        deadline = loop.time() + run_timeout
+        while pending and loop.time() < deadline:
+            done, pending = await asyncio.wait(
+                pending, timeout=deadline - loop.time(),
+                return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                try:
+                    page, validators = task.result()
+                except UnreadablePageException as exception:
+                    on_error(keys[task], exception)
+                else:
+                    on_page(keys[task], page, validators)
+        if pending:
+            _log.warning('%d pages still unread after %d secs.',
+                         len(pending), run_timeout)
+        for task in pending:
+            task.cancel()
+            on_error(keys[task], UnreadablePageException(
+                'Reading stopped after {} secs.'.format(run_timeout)))
+        await asyncio.gather(*pending, return_exceptions=True)
+
+def fetch_all(to_fetch, on_page, on_error,
+              max_in_flight=10, request_timeout=30, run_timeout=300):
+    '''Blocking version of fetch_pages.'''
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(fetch_pages(to_fetch, on_page, on_error,
+                                            max_in_flight, request_timeout,
+                                            run_timeout))
+    finally:
+        loop.close()
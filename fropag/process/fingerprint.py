@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""Fingerprints of HTML tags, shared by the extraction backends.
+A fingerprint hashes a tag and its whole subtree : two equal tags,
+in the BeautifulSoup sense, have the same fingerprint."""
+
+import hashlib
+
+# Bytes kept from the hash of a tag
+FINGERPRINT_SIZE = 8
+
+def fingerprint(name, attributes, children):
+    """Hash a tag, given its name, its attributes (multi-valued
+    ones being tuples) and its children : the fingerprints of
+    its child tags, or its strings, in the document order.
+
+    >>> a = fingerprint('p', {'class': ('x', 'y')}, ['Text'])
+    >>> a == fingerprint('p', {'class': ('x', 'y')}, ['Text'])
+    True
+    >>> a == fingerprint('p', {'class': ('x', 'y')}, ['Te', 'xt'])
+    False
+    >>> len(fingerprint('div', {}, [a]))
+    8
+    """
+    digest = hashlib.sha1()
+    digest.update(repr((name, sorted(attributes.items()))).encode('utf-8'))
+    for child in children:
+        if isinstance(child, bytes):
+            digest.update(b'T' + child)
+        else:
+            text = child.encode('utf-8')
+            digest.update(b'S' + str(len(text)).encode() + b':' + text)
+    return digest.digest()[:FINGERPRINT_SIZE]
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""A token to tag lexicon, learned from the Stanford tagger output.
+
+Most words of a front page were already on the front pages of the
+previous days. When a token has always received the same tag, the
+lexicon gives it directly, and only the sentences with unknown or
+ambiguous tokens are sent to the Stanford tagger.
+The lexicon is stored as a gzipped text file, one token per line,
+followed by the tags it received and how many times."""
+
+import gzip
+import os
+import time
+from collections import Counter, defaultdict
+
+# A token must have been seen this many times, always with
+# the same tag, before the lexicon tags it by itself.
+MIN_OCCURRENCES = 3
+
+class Lexicon(object):
+    """Count, for every token, the tags it received.
+
+    >>> lexicon = Lexicon(min_occurrences=2)
+    >>> lexicon.learn([('chat', 'NC'), ('le', 'DET'), ('chat', 'NC')])
+    >>> lexicon.learn([('le', 'CLO')])
+    >>> lexicon.known_tag('chat')
+    'NC'
+    >>> lexicon.known_tag('le') is None
+    True
+    """
+    def __init__(self, min_occurrences=MIN_OCCURRENCES):
+        self.min_occurrences = min_occurrences
+        self.tags = defaultdict(Counter)
+
+    def __len__(self):
+        return len(self.tags)
+
+    def learn(self, tagged):
+        '''Record a list of (word, tag) pairs.'''
+        for word, tag in tagged:
+            self.tags[word][tag] += 1
+
+    def known_tag(self, token):
+        '''Return the tag of token if it is not ambiguous
+        and was seen often enough ; None otherwise.'''
+        seen = self.tags.get(token)
+        if seen is None or len(seen) != 1:
+            return None
+        tag, count = next(iter(seen.items()))
+        if count < self.min_occurrences:
+            return None
+        return tag
+
+    def save(self, path):
+        '''Write the lexicon on disk.'''
+        with gzip.open(path, 'wt', encoding='utf-8') as lexicon_file:
+            for word in sorted(self.tags):
+                counts = ' '.join('{}={}'.format(tag, count) for tag, count
+                                  in sorted(self.tags[word].items()))
+                lexicon_file.write('{}\t{}\n'.format(word, counts))
+
+    @classmethod
+    def load(cls, path, min_occurrences=MIN_OCCURRENCES):
+        '''Read a lexicon saved with save. If there is no
+        such file, return an empty lexicon.'''
+        lexicon = cls(min_occurrences)
+        if not os.path.exists(path):
+            return lexicon
+        with gzip.open(path, 'rt', encoding='utf-8') as lexicon_file:
+            for line in lexicon_file:
+                word, counts = line.rstrip('\n').split('\t')
+                for tag_and_count in counts.split():
+                    tag, count = tag_and_count.rsplit('=', 1)
+                    lexicon.tags[word][tag] = int(count)
+        return lexicon
+
+# Tokens ending a sentence
+SENTENCE_ENDS = frozenset(['.', '!', '?', '...'])
+
+def split_sentences(tokens):
+    """Split a list of tokens after each token ending a sentence.
+
+    >>> split_sentences(['Il', 'dort', '.', 'Le', 'chat'])
+    [['Il', 'dort', '.'], ['Le', 'chat']]
+    """
+    sentences = [[]]
+    for token in tokens:
+        sentences[-1].append(token)
+        if token in SENTENCE_ENDS:
+            sentences.append([])
+    return [sentence for sentence in sentences if sentence]
+
+def tag_sentences(lexicon, texts, full_tagger, learn=True):
+    """Tag lists of tokens, sentence by sentence : the lexicon tags
+    the sentences whose tokens it all knows, and full_tagger
+    (a function tagging lists of tokens) the others, in one call,
+    so that ambiguous or unknown tokens are tagged in their context.
+    Unless learn is False, what full_tagger answers is added to the
+    lexicon, so a known token tagged differently in context becomes
+    ambiguous.
+
+    >>> lexicon = Lexicon(min_occurrences=1)
+    >>> lexicon.learn([('le', 'DET'), ('chat', 'NC'), ('.', 'PUNC')])
+    >>> tagger = lambda sentences: [[(t, 'V') for t in s] for s in sentences]
+    >>> tag_sentences(lexicon, [['le', 'chat', '.', 'le', 'chat', 'dort']],
+    ...               tagger)
+    [[('le', 'DET'), ('chat', 'NC'), ('.', 'PUNC'), ('le', 'V'), ('chat', 'V'), ('dort', 'V')]]
+    >>> lexicon.known_tag('dort'), lexicon.known_tag('chat') is None
+    ('V', True)
+    """
+    texts = [split_sentences([t for t in tokens if t.strip()])
+             for tokens in texts]
+    known = [[[lexicon.known_tag(t) for t in sentence] for sentence in text]
+             for text in texts]
+    to_tag = [sentence for text, tags in zip(texts, known)
+              for sentence, sentence_tags in zip(text, tags)
+              if None in sentence_tags]
+    tagged = iter(full_tagger(to_tag) if to_tag else [])
+    results = []
+    for text, tags in zip(texts, known):
+        result = []
+        for sentence, sentence_tags in zip(text, tags):
+            if None not in sentence_tags:
+                result.extend(zip(sentence, sentence_tags))
+                continue
+            in_context = next(tagged)
+            if learn:
+                lexicon.learn(in_context)
+            result.extend(in_context)
+        results.append(result)
+    return results
+
+def hold_out(items, every):
+    """Split items in those to learn from, and one out of every
+    to evaluate on.
+
+    >>> hold_out([1, 2, 3, 4, 5, 6], 3)
+    ([1, 2, 4, 5], [3, 6])
+    """
+    learned = [item for i, item in enumerate(items, 1) if i % every]
+    evaluated = [item for i, item in enumerate(items, 1) if not i % every]
+    return learned, evaluated
+
+def compare_taggers(lexicon, sentences, full_tagger, trim):
+    """Tag sentences with the full tagger, then with the lexicon,
+    and compare speed and results. The results are compared once
+    trimmed by the trim function, as only those words are counted."""
+    time0 = time.time()
+    reference = full_tagger(sentences)
+    full_time = time.time() - time0
+    time0 = time.time()
+    fast = tag_sentences(lexicon, sentences, full_tagger, learn=False)
+    fast_time = time.time() - time0
+    tokens = sum(len(s) for s in fast)
+    from_lexicon = sum(len(sentence) for tokens_of in sentences
+                       for sentence in split_sentences(
+                           [t for t in tokens_of if t.strip()])
+                       if all(lexicon.known_tag(t) is not None
+                              for t in sentence))
+    kept_reference = Counter(w for s in reference for w in trim(s))
+    kept_fast = Counter(w for s in fast for w in trim(s))
+    common = sum((kept_reference & kept_fast).values())
+    return {'tokens': tokens,
+            'lexicon_size': len(lexicon),
+            'from_lexicon': from_lexicon,
+            'full_time': full_time,
+            'lexicon_time': fast_time,
+            'precision': common / max(1, sum(kept_fast.values())),
+            'recall': common / max(1, sum(kept_reference.values()))}
+
+def format_report(report):
+    """Render the result of compare_taggers for the console.
+
+    >>> print(format_report({'tokens': 100, 'lexicon_size': 10,
+    ...                      'from_lexicon': 80, 'full_time': 2.0,
+    ...                      'lexicon_time': 0.5, 'precision': 0.99,
+    ...                      'recall': 0.98}))
+    Lexicon of 10 tokens, used for 80 tokens out of 100 (80.0%).
+    Full tagger : 2.00 secs. Lexicon tagger : 0.50 secs (x4.0).
+    Counted words : precision 99.0%, recall 98.0%.
+    """
+    coverage = 100 * report['from_lexicon'] / max(1, report['tokens'])
+    speedup = report['full_time'] / max(report['lexicon_time'], 1e-6)
+    return '\n'.join([
+        'Lexicon of {} tokens, used for {} tokens out of {} ({:.1f}%).'.\
+            format(report['lexicon_size'], report['from_lexicon'],
+                   report['tokens'], coverage),
+        'Full tagger : {:.2f} secs. Lexicon tagger : {:.2f} secs (x{:.1f}).'.\
+            format(report['full_time'], report['lexicon_time'], speedup),
+        'Counted words : precision {:.1f}%, recall {:.1f}%.'.\
+            format(100 * report['precision'], 100 * report['recall'])])
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""An lxml version of the text extraction of the reader module.
+
+BeautifulSoup, and especially its pure-Python html.parser, is
+the slowest part of the reading of a front page. This module
+parses pages with lxml, skips script and style while it
+fingerprints the tags, and gets the text in a single pass.
+Fingerprints are computed as in the reader module, so both
+backends can use each other's fingerprint files."""
+
+from lxml import etree
+
+from process.fingerprint import fingerprint
+
+# Tags whose content is not text.
+DROPPED_TAGS = ('script', 'style')
+
+# Attributes BeautifulSoup splits into lists of values.
+MULTI_VALUED_ATTRIBUTES = {'*': ('class', 'accesskey', 'dropzone'),
+                           'a': ('rel', 'rev'),
+                           'link': ('rel', 'rev'),
+                           'td': ('headers',),
+                           'th': ('headers',),
+                           'form': ('accept-charset',),
+                           'object': ('archive',),
+                           'area': ('rel',),
+                           'icon': ('sizes',),
+                           'iframe': ('sandbox',),
+                           'output': ('for',)}
+
+def parse(html):
+    '''Parse an HTML document. Return its root element,
+    or None for an empty document.'''
+    if html is None or not html.strip():
+        return None
+    parser = etree.HTMLParser(encoding='utf-8')
+    return etree.fromstring(html.encode('utf-8'), parser)
+
+def is_tag(element):
+    '''Elements are tags, comments or processing instructions.'''
+    return isinstance(element.tag, str)
+
+def attributes_of(element):
+    """Attributes of an element, the way BeautifulSoup sees them.
+
+    >>> element = parse('<a class="x  y" rel="nofollow" id="1">A</a>').find('.//a')
+    >>> sorted(attributes_of(element).items())
+    [('class', ('x', 'y')), ('id', '1'), ('rel', ('nofollow',))]
+    """
+    multi_valued = MULTI_VALUED_ATTRIBUTES['*'] + \
+                   MULTI_VALUED_ATTRIBUTES.get(element.tag, ())
+    return dict((key, tuple(value.split()) if key in multi_valued else value)
+                for key, value in element.attrib.items())
+
+def tree_fingerprints(elements):
+    '''Fingerprints of every tag (identified by its id) of a list
+    of elements given in the document order.'''
+    prints = {}
+    for element in reversed(elements):
+        if not is_tag(element) or element.tag in DROPPED_TAGS:
+            continue
+        children = [element.text] if element.text else []
+        for child in element:
+            if not is_tag(child):
+                # Comments are strings for BeautifulSoup
+                children.append(child.text or '')
+            elif child.tag not in DROPPED_TAGS:
+                children.append(prints[id(child)])
+            if child.tail:
+                children.append(child.tail)
+        prints[id(element)] = fingerprint(element.tag, attributes_of(element),
+                                          children)
+    return prints
+
+def visible_text(root, removed):
+    """Text of a document, without the removed tags (given by
+    their id), script, style and comments.
+
+    >>> visible_text(parse('<p>A<script>x</script>B<!-- c --><b>C</b>D</p>'), set())
+    'A B C D'
+    """
+    strings = [root.text] if root.text else []
+    stack = [(root, iter(root))]
+    while stack:
+        element, children = stack[-1]
+        child = next(children, None)
+        if child is None:
+            stack.pop()
+            if stack and element.tail:
+                strings.append(element.tail)
+        elif (is_tag(child) and child.tag not in DROPPED_TAGS
+              and id(child) not in removed):
+            if child.text:
+                strings.append(child.text)
+            stack.append((child, iter(child)))
+        elif child.tail:
+            strings.append(child.tail)
+    return u' '.join(strings).strip()
+
+def lxml_extract(previous, new, previous_prints=None):
+    """Same as extract_content_and_fingerprints in the reader
+    module : remove from the new document the tags of the previous
+    one (or whose fingerprints are given), and return the text and
+    the fingerprints of the new document.
+
+    >>> menu = '<div class="menu"><a>Choice1</a><a>Choice2</a></div>'
+    >>> text, prints = lxml_extract('<html><body>' + menu + '<p>One text.</p>',
+    ...                             '<html><body>' + menu + '<p>Another text.</p>')
+    >>> text
+    'Another text.'
+    """
+    root = parse(new)
+    if root is None:
+        return '', []
+    # Keep every element alive, so their ids stay theirs.
+    elements = list(root.iter())
+    prints = tree_fingerprints(elements)
+    if previous_prints is None and previous is not None:
+        previous_root = parse(previous)
+        if previous_root is not None:
+            previous_elements = list(previous_root.iter())
+            previous_prints = set(tree_fingerprints(previous_elements).values())
+    removed = set()
+    if previous_prints is not None:
+        for element in elements:
+            if id(element) not in prints:
+                continue
+            parent = element.getparent()
+            if (parent is not None and id(parent) in removed) or \
+               prints[id(element)] in previous_prints:
+                removed.add(id(element))
+    return visible_text(root, removed), list(prints.values())
@@ -1,17 +1,42 @@
 '''This module handle the process of reading and
 analyzing front pages.'''
+import datetime
+import io
 import time
 import multiprocessing
+import queue
+import threading
 import logging
 
+from sqlalchemy import tuple_, select
+from sqlalchemy.dialects import postgresql
+
+import config
 from model.publication import Publication, Word, FrontPage, WordCount
+from model.rollup import transaction, refresh_front_pages
+from model.partition import ensure_partitions
+from model.core import rebuild_top_words, bump_generation
 from database import db_session, get_engine
 
-from process.reader import read_front_page, UnreadablePageException
-from process.analyze import get_stats, EmptyContentException
+from process.reader import process_front_page, UnreadablePageException
+from process.reader import get_validators, keep_snapshot
+from process import archive
+from process.reader import saved_frontpages, extract_content
+from process.analyze import get_stats, get_stats_batch, EmptyContentException
+from process.analyze import frontpage_to_text, stanford_tag, trim_unwanted_tags
+from process.analyze import get_lexicon, save_lexicon
+from process.lexicon import compare_taggers, format_report, hold_out
+from process.tagger import start_tagger_service, stop_tagger_service
+from process.tagger import use_tagger_service
+from process.tagger import TaggerException
+from process.fetcher import fetch_all
 
 _log = logging.getLogger('fropag.read')
 
+# One front page out of this many is kept aside to evaluate
+# the lexicon built from the others.
+LEXICON_HOLD_OUT = 5
+
 def read_only(pubs):
     '''Read only a list of publications.'''
     _log.info("Reading only " + ','.join(pubs))
@@ -27,84 +52,338 @@ def read_every():
 
 def read(publications):
     '''Read the publications received as parameter.
-    This being a lengthy process, we'll try and multiprocess 
-    it to improve its efficiency.'''
+    This being a lengthy process, it is done as a pipeline :
+    every front page is downloaded at once ; as soon as one arrives,
+    it is analyzed by a pool of processes (one per core) ; as soon
+    as it is analyzed, a saver thread writes it in the database,
+    then records it in the archive index, with its validators, so
+    that the next reading only compares with it, or skips it, once
+    it was saved.
+    The taggers are launched once for the whole reading, and
+    shared by every process. In batch mode, processes only read
+    the front pages, and a tagging thread tags together every
+    front page read while it was tagging the previous ones.'''
     time0 = time.time()
-    processes = []
-    results = []
-    manager = multiprocessing.Manager()
-    results = manager.list()
-    logs = manager.list()
-    for pub in publications:
-        processes.append(multiprocessing.Process(target=read_and_analyze,
-                                                 args=(pub, results, logs,)))
-    [p.start() for p in processes]
-    [p.join() for p in processes]
+    # Words may have been modified since the previous reading.
+    forget_word_ids()
+    logs = []
+    unchanged = []
+    saved = []
+    pages = {}
+    to_save = queue.Queue()
+    saver = threading.Thread(target=save_from_queue,
+                             args=(to_save, saved, pages))
+    saver.start()
+    to_tag = queue.Queue()
+    tagging = threading.Thread(target=tag_from_queue,
+                               args=(to_tag, to_save, logs))
+    target = read_only_text if config.BATCH_TAGGING else read_and_analyze
+    # Workers only get plain ids, names and urls.
+    to_read = [(pub.id, pub.name, pub.url) for pub in publications]
+    address = start_tagger_service(config.TAGGER_POOL_SIZE)
+    pool = multiprocessing.Pool(config.READ_WORKERS,
+                                initializer=use_tagger_service,
+                                initargs=(address,))
+    tagging.start()
+    try:
+        def on_result(result):
+            '''Send an analyzed front page to the saver.'''
+            publication_id, name, value, error = result
+            if error is not None:
+                logs.append(error)
+            elif config.BATCH_TAGGING:
+                to_tag.put((publication_id, name, value))
+            else:
+                to_save.put((publication_id, value))
+        def on_crash(exception):
+            '''Keep track of unexpected failures of the workers.'''
+            logs.append('Analysis failed : {}'.format(exception))
+        def start_analysis(pub, page, validators):
+            '''Analyze a front page that just arrived,
+            unless it did not change since the last reading.'''
+            if page is None:
+                unchanged.append(pub[1])
+                return
+            pages[pub[0]] = (pub[2], archive.digest_of(page), validators)
+            pool.apply_async(target, pub + (page,),
+                             callback=on_result, error_callback=on_crash)
+        def log_failure(pub, exception):
+            '''Keep track of the front pages we could not download.'''
+            logs.append('{} cannot be read : {}'.format(pub[1], exception))
+        fetch_all([(pub, pub[2], get_validators(pub[2])) for pub in to_read],
+                  start_analysis, log_failure,
+                  config.FETCH_MAX_IN_FLIGHT, config.FETCH_TIMEOUT,
+                  config.READ_TIMEOUT)
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+        to_tag.put(None)
+        tagging.join()
+        stop_tagger_service()
+        to_save.put(None)
+        saver.join()
+    save_lexicon()
 
     for error in logs:
         _log.error(error)
 
+    if saved:
+        _log.info(rebuild_top_words())
     _log.info("Finished reading.")
-    save_all(results)
-    return "Read and analyzed {} front pages in {} secs.".\
-           format(len(publications), str(time.time() - time0))
+    summary = "Read and analyzed {} front pages in {} secs.".\
+              format(len(saved), str(time.time() - time0))
+    if unchanged:
+        summary += " Unchanged : {}.".format(', '.join(unchanged))
+    return summary
 
 
-def read_and_analyze(publication, results, error_log):
-    '''Read a frontpage using the reader module.
-    Put the result in a queue.'''
+def read_and_analyze(publication_id, name, url, raw_html):
+    '''Read a downloaded frontpage using the reader module, and
+    analyze it. Return the publication id and name, the stats,
+    and an error message if something went wrong.'''
     try:
-        page = read_front_page(publication.url)
-        stats = get_stats(page)
-        results.append((publication, stats))
+        page = process_front_page(url, raw_html)
+        return (publication_id, name, get_stats(page), None)
     except UnreadablePageException as exception:
-        error_log.append('{} cannot be read : {}'.format(publication.name,
-                                                         exception))
-        return
+        return (publication_id, name, None,
+                '{} cannot be read : {}'.format(name, exception))
     except EmptyContentException:
-        error_log.append('No content for {}.'.format(publication.name))
-        return
+        return (publication_id, name, None, 'No content for {}.'.format(name))
+    except TaggerException as exception:
+        return (publication_id, name, None,
+                '{} cannot be tagged : {}'.format(name, exception))
+
+def read_only_text(publication_id, name, url, raw_html):
+    '''Read a downloaded frontpage using the reader module, without
+    analyzing it. Return the publication id and name, the text,
+    and an error message if something went wrong.'''
+    try:
+        return (publication_id, name,
+                process_front_page(url, raw_html), None)
+    except UnreadablePageException as exception:
+        return (publication_id, name, None,
+                '{} cannot be read : {}'.format(name, exception))
+
+def analyze_all(publication_and_texts, error_log):
+    '''Take a list of publication ids, names and text of their
+    frontpage, and analyze them with a single batch tagging.
+    Return a list of publication ids and stats.'''
+    try:
+        all_stats = get_stats_batch([t[2] for t in publication_and_texts])
+    except TaggerException as exception:
+        error_log.append('Front pages cannot be tagged : {}'.format(exception))
+        return []
+    results = []
+    for (p_id, name, text), stats in zip(publication_and_texts, all_stats):
+        if stats is None:
+            error_log.append('No content for {}.'.format(name))
+        else:
+            results.append((p_id, stats))
+    return results
 
-def save_words(publication_id, propers, commons):
-    # Get id for words - this is going to be slow - particularly for new words
-    # but session cache-like abilities could help us
+def lexicon_report(build):
+    '''Compare the Stanford tagger and the lexicon tagger on
+    every front page saved in the corpus directory.
+    If build is True, the lexicon first learns from those front
+    pages, but one out of LEXICON_HOLD_OUT, on which it is then
+    compared, and is saved.'''
+    sentences = [frontpage_to_text(extract_content(None, html)).tokens
+                 for html in saved_frontpages()]
+    start_tagger_service(config.TAGGER_POOL_SIZE)
+    try:
+        lexicon = get_lexicon()
+        if build:
+            learned, sentences = hold_out(sentences, LEXICON_HOLD_OUT)
+            for tagged in stanford_tag(learned):
+                lexicon.learn(tagged)
+            save_lexicon()
+        report = compare_taggers(lexicon, sentences, stanford_tag,
+                                 trim_unwanted_tags)
+    finally:
+        stop_tagger_service()
+    return format_report(report)
+
+def counted_words(propers, commons):
+    '''((word, proper), count) pairs of the words of a front page.'''
+    return [((w, True), c) for w, c in propers.items()] + \
+           [((w, False), c) for w, c in commons.items()]
+
+def word_count_rows(frontpage_id, time_of_publication, propers, commons):
+    '''Rows of the wordcount table for the words of a front page.'''
     _log.info('Checking for new words and getting word ids...')
-    proper_nouns = [(get_word_id_or_add_it(w[0], True), w[1]) 
-                        for w in propers.items()]
-    common_nouns = [(get_word_id_or_add_it(w[0], False), w[1]) 
-                        for w in commons.items()]
+    counts = counted_words(propers, commons)
+    word_ids = get_word_ids([key for key, _ in counts])
     _log.info('Done.')
+    return [{'count' : c, 'frontpage_id' : frontpage_id,
+             'time_of_publication' : time_of_publication,
+             'word_id' : word_ids[key]} for key, c in counts]
 
-    engine = get_engine()
+def save_words(frontpage_id, propers, commons):
+    time_of_publication = get_engine().execute(
+        select([FrontPage.time_of_publication]).\
+        where(FrontPage.id == frontpage_id)).scalar()
+    rows = word_count_rows(frontpage_id, time_of_publication,
+                           propers, commons)
     # This being bulk inserts, we're going to use SqlAlchemy Core
-    if common_nouns:
-        engine.execute(
-            WordCount.__table__.insert(),
-            [{'count' : w[1], 'frontpage_id' : publication_id,
-              'word_id' : w[0]} for w in common_nouns])
-    _log.info('Added common words.')
-    if proper_nouns:
-        engine.execute(
-            WordCount.__table__.insert(),
-            [{'count' : w[1], 'frontpage_id' : publication_id,
-              'word_id' : w[0]} for w in proper_nouns])
-    _log.info('Added proper nouns.')
-
-def save_all(publication_and_results):
-    '''Take a list of publication object and stats extracted
-    from its frontpage and save the result in the database.'''
-    for pair in publication_and_results:
-        # This will get us a pair (Publication, (Stats))
-        publication = pair[0]
-        _log.info('Saving information for %s', publication.name)
-        stats = pair[1]
-        new_front_page = FrontPage(publication_id=publication.id,
-                                   lexical_richness=stats[2])
-        db_session.begin()
-        db_session.add(new_front_page)
-        db_session.commit()
-        _log.info('Added frontpage.')
-        save_words(new_front_page.id, stats[0], stats[1])
+    if rows:
+        ensure_partitions([time_of_publication])
+        get_engine().execute(WordCount.__table__.insert(), rows)
+    _log.info('Added common words and proper nouns.')
+    with transaction() as connection:
+        refresh_front_pages(connection, [frontpage_id])
+
+def save_all(publication_and_results, time_of_publication=None):
+    '''Take a list of publication ids and stats extracted
+    from their frontpage and save the result in the database,
+    dated now, unless another time_of_publication is given.'''
+    save_batch([(publication_id, stats, time_of_publication)
+                for publication_id, stats in publication_and_results])
+    bump_generation()
+
+def save_batch(dated_results):
+    '''Take a list of publication ids, stats and dates of front
+    pages (None for now), and save them all. With PostgreSQL,
+    they are copied in a single transaction ; otherwise front pages
+    are saved in one transaction, then their words in a single
+    insert.'''
+    if can_copy():
+        copy_front_pages(dated_results)
+        return
+    front_pages = []
+    for publication_id, stats, time_of_publication in dated_results:
+        front_page = FrontPage(publication_id=publication_id,
+                               lexical_richness=stats[2])
+        if time_of_publication is not None:
+            front_page.time_of_publication = time_of_publication
+        front_pages.append(front_page)
+    db_session.begin()
+    db_session.add_all(front_pages)
+    db_session.commit()
+    rows = []
+    for front_page, (_, stats, _) in zip(front_pages, dated_results):
+        rows.extend(word_count_rows(front_page.id,
+                                    front_page.time_of_publication,
+                                    stats[0], stats[1]))
+    if rows:
+        ensure_partitions([fp.time_of_publication for fp in front_pages])
+        get_engine().execute(WordCount.__table__.insert(), rows)
+    with transaction() as connection:
+        refresh_front_pages(connection, [fp.id for fp in front_pages])
+    _log.info('Added %d front pages and %d word counts.',
+              len(front_pages), len(rows))
+
+def can_copy():
+    '''COPY can only be used with PostgreSQL, through psycopg2.'''
+    dialect = get_engine().dialect
+    return config.BULK_COPY and dialect.name == 'postgresql' \
+           and dialect.driver == 'psycopg2'
+
+def copy_front_pages(dated_results):
+    '''Same as save_batch, but the front pages and their words
+    are streamed to PostgreSQL with COPY, and the rollups updated,
+    in a single transaction : either every front page is saved,
+    or none of them.
+    Return the ids of the new front pages.'''
+    now = datetime.datetime.utcnow()
+    all_counts = [counted_words(stats[0], stats[1])
+                  for _, stats, _ in dated_results]
+    # New words are committed first : adding a word twice is harmless.
+    word_ids = get_word_ids([key for counts in all_counts
+                             for key, _ in counts])
+    times = [time_of_publication or now
+             for _, _, time_of_publication in dated_results]
+    ensure_partitions(times)
+    with transaction() as connection:
+        cursor = connection.connection.cursor()
+        cursor.execute("SELECT nextval(pg_get_serial_sequence("
+                       "'frontpage', 'id')) "
+                       "FROM generate_series(1, %s)",
+                       (len(dated_results),))
+        ids = [row[0] for row in cursor.fetchall()]
+        front_pages = io.StringIO()
+        word_counts = io.StringIO()
+        for frontpage_id, (publication_id, stats, _), time_of_publication, \
+            counts in zip(ids, dated_results, times, all_counts):
+            front_pages.write('{}\t{}\t{}\t{}\n'.format(
+                frontpage_id, publication_id,
+                time_of_publication.isoformat(), stats[2]))
+            for key, count in counts:
+                word_counts.write('{}\t{}\t{}\t{}\n'.format(
+                    frontpage_id, time_of_publication.isoformat(),
+                    word_ids[key], count))
+        front_pages.seek(0)
+        word_counts.seek(0)
+        cursor.copy_expert("COPY frontpage (id, publication_id, "
+                           "time_of_publication, lexical_richness) "
+                           "FROM STDIN", front_pages)
+        cursor.copy_expert("COPY wordcount (frontpage_id, "
+                           "time_of_publication, word_id, count) "
+                           "FROM STDIN", word_counts)
+        refresh_front_pages(connection, ids)
+    _log.info('Copied %d front pages and %d word counts.',
+              len(ids), sum(len(counts) for counts in all_counts))
+    return ids
+
+def save_from_queue(to_save, saved, pages=None):
+    '''Saver stage of the reading : save the pairs of publication
+    id and stats as soon as they arrive in the to_save queue, until
+    None arrives. Every pair waiting in the queue is saved at
+    once. Ids of saved publications go in saved. pages gives
+    the url, hash and validators of the front pages, by publication
+    id : they are kept with keep_snapshot once it is saved, with
+    the date of the front page, so that replaying the archive
+    replaces it.'''
+    finished = False
+    while not finished:
+        results, finished = take_waiting(to_save)
+        if not results:
+            continue
+        try:
+            now = archive.timestamp_now()
+            save_all(results, now)
+            saved.extend(result[0] for result in results)
+            for result in results:
+                if pages and result[0] in pages:
+                    url, digest, validators = pages[result[0]]
+                    keep_snapshot(url, digest, validators, now)
+        except Exception as exception:
+            # The next results must still be saved.
+            _log.error('Could not save publications %s : %s',
+                       ', '.join(str(result[0]) for result in results),
+                       exception)
+            db_session.rollback()
+    db_session.remove()
+
+def tag_from_queue(to_tag, to_save, error_log):
+    '''Tagging stage of a batch reading : tag together the
+    publication ids, names and texts waiting in the to_tag queue,
+    as soon as they arrive, and send their stats to the to_save
+    queue, until None arrives.'''
+    finished = False
+    while not finished:
+        texts, finished = take_waiting(to_tag)
+        if not texts:
+            continue
+        try:
+            for result in analyze_all(texts, error_log):
+                to_save.put(result)
+        except Exception as exception:
+            # The next front pages must still be tagged.
+            error_log.append('Could not analyze {} : {}'.format(
+                ', '.join(text[1] for text in texts), exception))
+
+def take_waiting(from_queue):
+    '''Wait for an item of the queue, then take it with every
+    item waiting behind it. Return them, but the None marking
+    the end, and whether this None was met.'''
+    items = [from_queue.get()]
+    while True:
+        try:
+            items.append(from_queue.get_nowait())
+        except queue.Empty:
+            break
+    return [item for item in items if item is not None], None in items
 
 def get_word_id_or_add_it(w, p):
     """Get the id of w in the database.
@@ -119,3 +398,62 @@ def get_word_id_or_add_it(w, p):
         db_session.add(new_word)
         db_session.commit()
         return new_word.id
+
+# Ids of the (word, proper) pairs already met by this process.
+_word_ids = {}
+# Words looked for, or inserted, by a single query.
+WORDS_PER_QUERY = 1000
+
+def forget_word_ids():
+    '''Empty the cache of word ids, e.g. when the word
+    table was emptied, or a word became a proper noun.'''
+    _word_ids.clear()
+
+def get_word_ids(words):
+    """Take a list of (word, proper) pairs, and return a dict
+    giving the id of each of them, adding the missing ones
+    to the database. Ids are cached ; the ones that are
+    not are looked for in a single query, and the new words
+    are inserted in a single query too."""
+    missing = set(words) - set(_word_ids)
+    if missing:
+        _word_ids.update(find_word_ids(missing))
+        missing -= set(_word_ids)
+    if missing:
+        _word_ids.update(add_words(missing))
+    return dict((key, _word_ids[key]) for key in words)
+
+def find_word_ids(words):
+    '''Ids of those of the (word, proper) pairs that are
+    in the database.'''
+    found = {}
+    words = sorted(words)
+    for start in range(0, len(words), WORDS_PER_QUERY):
+        chunk = words[start:start + WORDS_PER_QUERY]
+        found.update(((w, p), i) for w, p, i in
+                     db_session.query(Word.word, Word.proper, Word.id).\
+                     filter(tuple_(Word.word, Word.proper).in_(chunk)))
+    return found
+
+def add_words(words):
+    '''Insert the (word, proper) pairs and return their ids.
+    A word inserted meanwhile by another process is not
+    inserted again, but looked for.'''
+    engine = get_engine()
+    if engine.dialect.name != 'postgresql':
+        return dict(((w, p), get_word_id_or_add_it(w, p)) for w, p in words)
+    _log.debug("Adding %d words", len(words))
+    added = {}
+    # Always in the same order, so concurrent inserts cannot deadlock.
+    words = sorted(words)
+    for start in range(0, len(words), WORDS_PER_QUERY):
+        chunk = words[start:start + WORDS_PER_QUERY]
+        statement = postgresql.insert(Word.__table__).\
+                    values([{'word' : w, 'proper' : p} for w, p in chunk]).\
+                    on_conflict_do_nothing(index_elements=['word', 'proper']).\
+                    returning(Word.word, Word.proper, Word.id)
+        added.update(((w, p), i) for w, p, i in engine.execute(statement))
+    concurrent = set(words) - set(added)
+    if concurrent:
+        added.update(find_word_ids(concurrent))
+    return added
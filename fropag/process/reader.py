@@ -5,12 +5,35 @@ and simply render a Counter object for this words.
 External modules should only have to use the read_front_page
 method."""
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, Tag
 import urllib.request
-from urllib.error import HTTPError
+from urllib.error import HTTPError, URLError
+import bisect
+import hashlib
+import json
+import mmap
 import os
+import socket
+import zlib
+
+import config
+from process import archive
+from process.fingerprint import fingerprint, FINGERPRINT_SIZE
+try:
+    from process.lxml_reader import lxml_extract
+except ImportError:
+    # lxml is optional : BeautifulSoup will be used instead.
+    lxml_extract = None
 
 HTTP_PREFIX = "http://"
+# Seconds before giving up on a page
+DEFAULT_TIMEOUT = 30
+# Suffix of the files keeping the ETag, Last-Modified
+# and hash of the last version of a front page
+VALIDATORS_SUFFIX = ".validators"
+# Suffix of the files keeping the fingerprints of
+# the tags of the last version of a front page
+FINGERPRINTS_SUFFIX = ".fingerprints"
 
 class UnreadablePageException(Exception):
     '''This exception should be raised when a frontpage
@@ -34,13 +57,21 @@ def unprefixed_url(newspaper_url):
 
 def get_previous_frontpage(url):
     """Read the last recorded version of this frontpage,
-    that should have been saved in the corpus directory.
+    that should have been saved in the corpus archive (or,
+    for older versions, directly in the corpus directory).
     If it cannot be found, will return None."""
+    latest = archive.latest_snapshot(url)
+    if latest is not None:
+        return archive.read_snapshot(latest[1])
     dest = os.path.join("corpus", unprefixed_url(url))
-    if os.path.exists(dest):
+    if os.path.isfile(dest):
         with open(dest, 'r') as previous_file:
             return previous_file.read()
 
+def saved_frontpages():
+    """Read every distinct frontpage saved in the corpus archive."""
+    return [archive.read_snapshot(digest) for digest in archive.all_digests()]
+
 def extract_script_and_style(soup):
     """Remove the script and style tag from an HTML document
     in BeautifulSoup format.
@@ -68,13 +99,97 @@ def compare(previous, new):
     >>> doc2.get_text().strip()
     'Another text.'
     """
+    # Two tags are equal when their whole subtrees are : instead
+    # of comparing every couple of tags, compare their fingerprints.
+    prints_of_previous = set(subtree_fingerprints(previous).values())
+    remove_known_tags(prints_of_previous, new, subtree_fingerprints(new))
+
+def remove_known_tags(known_prints, new, prints_of_new):
+    """Remove from an HTML document in BeautifulSoup format every
+    tag whose fingerprint (given by prints_of_new) is known."""
     to_remove = []
-    tags_of_previous = previous.find_all(True)
+    removed = set()
     for new_tag in new.find_all(True):
-        if new_tag in tags_of_previous:
+        if id(new_tag.parent) in removed:
+            # Will go away with its parent.
+            removed.add(id(new_tag))
+        elif prints_of_new[id(new_tag)] in known_prints:
+            removed.add(id(new_tag))
             to_remove.append(new_tag)
     [tag.decompose() for tag in to_remove]
 
+def subtree_fingerprints(soup):
+    """Give, for each tag of an HTML document in BeautifulSoup
+    format (identified by its id), a hash of its name, attributes
+    and content. Two tags have the same fingerprint if they are
+    equal, in the BeautifulSoup sense.
+
+    >>> doc = BeautifulSoup('<p><a id="1" class="x y">A</a></p>'
+    ...                     '<p><a class="x y" id="1">A</a></p>', 'html.parser')
+    >>> prints = subtree_fingerprints(doc)
+    >>> first, second = doc.find_all('p')
+    >>> prints[id(first)] == prints[id(second)]
+    True
+    >>> prints[id(first)] == prints[id(first.a)]
+    False
+    """
+    prints = {}
+    # Children come after their parent in the document order :
+    # going backwards, they are always fingerprinted first.
+    for element in reversed(list(soup.descendants)):
+        if not isinstance(element, Tag):
+            continue
+        attributes = dict((key, tuple(value) if isinstance(value, list)
+                           else value)
+                          for key, value in element.attrs.items())
+        children = [prints[id(child)] if isinstance(child, Tag)
+                    else str(child) for child in element.contents]
+        prints[id(element)] = fingerprint(element.name, attributes, children)
+    return prints
+
+class FingerprintFile(object):
+    """Fingerprints saved by save_fingerprints. The file is
+    memory-mapped, and searched through a binary search."""
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size // FINGERPRINT_SIZE
+        self.map = None
+        if self.size:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        start = index * FINGERPRINT_SIZE
+        return self.map[start:start + FINGERPRINT_SIZE]
+
+    def __contains__(self, fingerprint):
+        index = bisect.bisect_left(self, fingerprint)
+        return index < self.size and self[index] == fingerprint
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+def load_fingerprints(url):
+    """Open the fingerprints of the last recorded version of
+    this frontpage. If they cannot be found, will return None."""
+    latest = archive.latest_snapshot(url)
+    if latest is None:
+        return None
+    dest = archive.object_path(latest[1], FINGERPRINTS_SUFFIX)
+    if os.path.exists(dest):
+        return FingerprintFile(dest)
+
+def save_fingerprints(digest, fingerprints):
+    '''Save the fingerprints of the archived version of a
+    frontpage with this hash, sorted, as a binary file.'''
+    dest = archive.object_path(digest, FINGERPRINTS_SUFFIX)
+    if not os.path.exists(dest):
+        archive.write_atomically(dest, b''.join(sorted(set(fingerprints))))
+
 def extract_content(previous, new):
     """Get two HTML documents, previous and new and try to
     transform them to BeautifulSoup.
@@ -82,51 +197,181 @@ def extract_content(previous, new):
     remove any similarities - this will allow us to remove most
     of the template of the page.
     Then, get the text of the document."""
+    return extract_content_and_fingerprints(previous, new)[0]
+
+def extract_content_and_fingerprints(previous, new, previous_prints=None):
+    """Same as extract_content, but the fingerprints of the
+    previous document can be given instead of the document itself.
+    Return the text and the fingerprints of the new document.
+    Uses lxml if it is the configured backend and is installed."""
+    if config.EXTRACTION_BACKEND == 'lxml' and lxml_extract is not None:
+        return lxml_extract(previous, new, previous_prints)
     new = BeautifulSoup(new)
     extract_script_and_style(new)
-    if previous is not None:
+    prints_of_new = subtree_fingerprints(new)
+    if previous_prints is None and previous is not None:
         previous = BeautifulSoup(previous)
         extract_script_and_style(previous)
-        compare(previous, new)
-    return new.get_text(separator=u' ').strip()
+        previous_prints = set(subtree_fingerprints(previous).values())
+    if previous_prints is not None:
+        remove_known_tags(previous_prints, new, prints_of_new)
+    return (new.get_text(separator=u' ').strip(),
+            list(prints_of_new.values()))
 
 def read_front_page(newspaper_url):
-    """Read the front page of a newspaper."""
-    raw_html = access_page(newspaper_url)
-    previous = get_previous_frontpage(newspaper_url)
-    text = extract_content(previous, raw_html)
-    # Save the file in the corpus folder to be able
-    # to compare it with the next version
-    save_file(newspaper_url, raw_html)
+    """Read the front page of a newspaper.
+    Return None if it did not change since the last reading."""
+    raw_html, validators = access_page(newspaper_url,
+                                       validators=get_validators(newspaper_url))
+    if raw_html is None:
+        return None
+    text = process_front_page(newspaper_url, raw_html)
+    keep_snapshot(newspaper_url, archive.digest_of(raw_html), validators)
     return text
 
-def save_file(url, text):
-    '''Save a version of an HTML version, given its url
-    and its content, in the "corpus" directory.'''
-    dest = os.path.join("corpus", unprefixed_url(url))
-    with open(dest, 'w') as saving_file:
-        saving_file.write(text)
+def process_front_page(newspaper_url, raw_html):
+    """Get the text of a front page that has already been
+    downloaded, and store it in the archive. It is only compared
+    with the next version once its text was used, e.g. saved in
+    the database, and keep_snapshot was called."""
+    # Only the fingerprints of the previous version are needed ;
+    # versions saved before fingerprints existed are parsed again.
+    previous, previous_prints = None, load_fingerprints(newspaper_url)
+    if previous_prints is None:
+        previous = get_previous_frontpage(newspaper_url)
+    try:
+        text, prints = extract_content_and_fingerprints(previous, raw_html,
+                                                        previous_prints)
+    finally:
+        if previous_prints is not None:
+            previous_prints.close()
+    # Store the file in the corpus folder, with its fingerprints,
+    # to be able to compare it with the next version
+    save_fingerprints(archive.store_snapshot(raw_html), prints)
+    return text
 
-def access_page(url):
-    """Access a page at a given URL."""
+def keep_snapshot(url, digest, validators, timestamp=None):
+    '''Once the text of a front page was used, record its stored
+    version with this hash as the latest one, read at timestamp,
+    and keep its validators : the next reading compares with it,
+    and skips it if it did not change.'''
+    archive.index_snapshot(url, digest, timestamp)
+    save_validators(url, validators)
+
+def get_validators(url):
+    """Read what we know of the last version of this frontpage :
+    its ETag, Last-Modified date and hash."""
+    dest = archive.index_path(url, VALIDATORS_SUFFIX)
+    if os.path.exists(dest):
+        with open(dest, 'r') as validators_file:
+            return json.load(validators_file)
+    return {}
+
+def save_validators(url, validators):
+    '''Keep the ETag, Last-Modified date and hash of a
+    version of a frontpage, next to its index in the archive.'''
+    archive.write_atomically(archive.index_path(url, VALIDATORS_SUFFIX),
+                             json.dumps(validators), 'w')
+
+def conditional_headers(validators):
+    """Headers asking the server to answer only if the page
+    changed since the version we know, and to compress it.
+
+    >>> sorted(conditional_headers({'etag': '"a1"', 'last_modified': None}).items())
+    [('Accept-Encoding', 'gzip, deflate'), ('If-None-Match', '"a1"')]
+    """
+    headers = {'Accept-Encoding': 'gzip, deflate'}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+def check_changed(url, previous, raw, etag, last_modified):
+    """Return the validators of a downloaded page, or None
+    if its content is the same as the previous version.
+
+    >>> first = check_changed('http://t', {}, b'page', '"a1"', None)
+    >>> first['etag']
+    '"a1"'
+    >>> check_changed('http://t', first, b'page', '"a1"', None) is None
+    True
+    """
+    validators = {'etag': etag,
+                  'last_modified': last_modified,
+                  'hash': hashlib.sha1(raw).hexdigest()}
+    if previous.get('hash') == validators['hash']:
+        if validators != previous:
+            save_validators(url, validators)
+        return None
+    return validators
+
+def decompress(raw, content_encoding):
+    """Decompress a body sent with gzip or deflate.
+
+    >>> decompress(zlib.compress(b'page'), 'deflate')
+    b'page'
+    """
+    if content_encoding == 'gzip':
+        return zlib.decompress(raw, 16 + zlib.MAX_WBITS)
+    if content_encoding == 'deflate':
+        try:
+            return zlib.decompress(raw)
+        except zlib.error:
+            # Some servers send raw deflate, without the zlib header.
+            return zlib.decompress(raw, -zlib.MAX_WBITS)
+    return raw
+
+def access_page(url, timeout=DEFAULT_TIMEOUT, validators=None):
+    """Access a page at a given URL.
+    Return the page and its validators ; if the validators of
+    the previous version are given and the page did not change,
+    the page is None."""
+    validators = validators or {}
+    request = urllib.request.Request(url,
+                                     headers=conditional_headers(validators))
     try:
-        page = urllib.request.urlopen(url)
+        page = urllib.request.urlopen(request, timeout=timeout)
     except HTTPError as error_info:
+        if error_info.code == 304:
+            return None, validators
         error = 'Could not read the page at {}, got\
                       an HTTPError. {}'.format(url, str(error_info))
         raise UnreadablePageException(error)
+    except (URLError, socket.timeout) as error_info:
+        error = 'Could not reach the page at {} : {}'.format(url,
+                                                            str(error_info))
+        raise UnreadablePageException(error)
     encoding = page.headers.get_param('charset')
     if encoding is None:
         # let's try with the keys...
         keys = page.headers.keys()
         if 'charset' in keys:
             encoding = page.headers.values()[keys.index('charset')]
-        else:
-            encoding = 'utf-8'
     try:
-        result = str(page.read().decode(encoding))
-        return result
-    except UnicodeDecodeError as exc:
+        raw = decompress(page.read(), page.headers.get('Content-Encoding'))
+    except zlib.error as exc:
+        raise UnreadablePageException('Could not decompress the page at {} : {}'.\
+                                      format(url, str(exc)))
+    new_validators = check_changed(url, validators, raw,
+                                   page.headers.get('ETag'),
+                                   page.headers.get('Last-Modified'))
+    if new_validators is None:
+        return None, validators
+    return decode_page(url, raw, encoding), new_validators
+
+def decode_page(url, raw, encoding):
+    """Decode the body of a page, with utf-8 if
+    no encoding was given by the server.
+
+    >>> decode_page('http://test', 'é'.encode('latin-1'), 'latin-1')
+    'é'
+    """
+    if encoding is None:
+        encoding = 'utf-8'
+    try:
+        return str(raw.decode(encoding))
+    except (UnicodeDecodeError, LookupError) as exc:
         error = 'Could not read the page at {} with encoding {}.\
                        Got the exception : {}'.format(url, encoding, str(exc))
         raise UnreadablePageException(error)
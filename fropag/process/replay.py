@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""This module analyzes saved front pages again, without any download.
+
+When the extraction rules, the tagger or the unwanted tags change,
+the history can be computed again from the saved snapshots : each
+snapshot is read with the one before it as the previous version,
+by a pool of processes (one per core), and its stats are written
+with the date of the snapshot, replacing the front page saved with
+this date if there is one.
+Snapshots come from the corpus archive, or from a folder holding
+one folder per publication, named after it, filled with HTML
+pages named after their date, e.g. 2014-10-17T08:00:00.html."""
+
+import datetime
+import logging
+import multiprocessing
+import os
+import time
+
+import config
+from model.publication import Publication
+from model.core import rebuild_top_words, delete_front_pages_at
+from database import db_session
+
+from process import archive
+from process.reader import extract_content
+from process.analyze import get_stats, EmptyContentException
+from process.tagger import start_tagger_service, stop_tagger_service
+from process.tagger import use_tagger_service, TaggerException
+from process.read_process import save_batch
+
+_log = logging.getLogger('fropag.replay')
+
+# Names of the snapshots of a plain folder, without extension.
+FILE_DATE_FORMATS = (archive.TIMESTAMP_FORMAT, "%Y-%m-%d_%H-%M-%S",
+                     "%Y-%m-%d_%H%M", "%Y%m%d%H%M%S", "%Y-%m-%d", "%Y%m%d")
+SNAPSHOT_EXTENSIONS = ('.html.gz', '.htm.gz', '.html', '.htm')
+
+def date_of_file(name):
+    """Date of a snapshot named after it ; None if the
+    name is not a date, or not a page.
+
+    >>> date_of_file('2014-10-17T08:00:00.html')
+    datetime.datetime(2014, 10, 17, 8, 0)
+    >>> date_of_file('20141017.html.gz')
+    datetime.datetime(2014, 10, 17, 0, 0)
+    >>> date_of_file('index.html') is None
+    True
+    """
+    for extension in SNAPSHOT_EXTENSIONS:
+        if name.endswith(extension):
+            stem = name[:-len(extension)]
+            break
+    else:
+        return None
+    for date_format in FILE_DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(stem, date_format)
+        except ValueError:
+            continue
+    return None
+
+def archived_snapshots(publication):
+    '''(date, path) of every snapshot of a publication in the archive.'''
+    return [(timestamp, archive.object_path(digest))
+            for timestamp, digest in archive.snapshots_of(publication.url)]
+
+def folder_snapshots(folder, publication):
+    '''(date, path) of every snapshot of a publication
+    in its folder, if there is one.'''
+    publication_folder = os.path.join(folder, publication.name)
+    if not os.path.isdir(publication_folder):
+        return []
+    snapshots = []
+    for name in os.listdir(publication_folder):
+        date = date_of_file(name)
+        if date is None:
+            _log.warning('Ignoring %s : its name is not a date.', name)
+        else:
+            snapshots.append((date, os.path.join(publication_folder, name)))
+    return snapshots
+
+def replay_jobs(publications, snapshots_of):
+    '''One job for each snapshot of the publications : its
+    publication id and name, its date, the path of the snapshot
+    before it (or None for the first one), and its path.'''
+    jobs = []
+    for publication in publications:
+        previous = None
+        for date, path in sorted(snapshots_of(publication)):
+            # The same page read twice in a row was only saved once.
+            if path != previous:
+                jobs.append((publication.id, publication.name,
+                             date, previous, path))
+            previous = path
+    return jobs
+
+def replay_one(job):
+    '''Extract and analyze a snapshot. Return the publication id,
+    the date, the stats, and an error message if something
+    went wrong.'''
+    publication_id, name, date, previous_path, path = job
+    try:
+        previous = None
+        if previous_path is not None:
+            previous = archive.read_snapshot_file(previous_path)
+        text = extract_content(previous, archive.read_snapshot_file(path))
+        return (publication_id, date, get_stats(text), None)
+    except (OSError, UnicodeDecodeError) as exception:
+        return (publication_id, date, None,
+                'Cannot open {} : {}'.format(path, exception))
+    except EmptyContentException:
+        return (publication_id, date, None,
+                'No content for {} on {}.'.format(name, date))
+    except TaggerException as exception:
+        return (publication_id, date, None,
+                '{} on {} cannot be tagged : {}'.format(name, date, exception))
+
+def save_replayed(batch):
+    '''Save a batch of publication ids, stats and dates, once the
+    front pages already saved for those dates are deleted, so that
+    replaying a snapshot twice does not count its words twice.'''
+    replaced = delete_front_pages_at([(publication_id, date) for
+                                      publication_id, _, date in batch])
+    if replaced:
+        _log.info('Replacing %d front pages.', replaced)
+    save_batch(batch)
+
+def progress(done, total, words, elapsed):
+    """Progress and throughput of a replay.
+
+    >>> progress(200, 1000, 50000, 10.0)
+    'Replayed 200/1000 front pages - 20.0 pages/sec, 5000 words/sec.'
+    """
+    elapsed = max(elapsed, 1e-6)
+    return 'Replayed {}/{} front pages - {:.1f} pages/sec, {:.0f} words/sec.'.\
+           format(done, total, done / elapsed, words / elapsed)
+
+def replay(folder, names=None, report=print):
+    '''Analyze again every snapshot of the publications (all of
+    them, or only those whose names are given) saved in folder,
+    and save their stats with the date of the snapshot, instead of
+    the ones saved for this date. Stats are written by batches, and report is given the progress
+    after each batch.'''
+    time0 = time.time()
+    query = db_session.query(Publication)
+    if names:
+        query = query.filter(Publication.name.in_(names))
+    publications = query.all()
+    if os.path.isdir(os.path.join(folder, "index")):
+        previous_archive_dir = archive.ARCHIVE_DIR
+        archive.ARCHIVE_DIR = folder
+        try:
+            jobs = replay_jobs(publications, archived_snapshots)
+        finally:
+            archive.ARCHIVE_DIR = previous_archive_dir
+    else:
+        jobs = replay_jobs(publications,
+                           lambda pub: folder_snapshots(folder, pub))
+    if not jobs:
+        return "No snapshot to replay in {}.".format(folder)
+    _log.info('Replaying %d snapshots from %s.', len(jobs), folder)
+
+    logs = []
+    batch = []
+    done = saved = words = 0
+    address = start_tagger_service(config.TAGGER_POOL_SIZE)
+    pool = multiprocessing.Pool(config.READ_WORKERS,
+                                initializer=use_tagger_service,
+                                initargs=(address,))
+    try:
+        for publication_id, date, stats, error in \
+                pool.imap_unordered(replay_one, jobs, chunksize=4):
+            done += 1
+            if error is not None:
+                logs.append(error)
+            else:
+                batch.append((publication_id, stats, date))
+                words += sum(stats[0].values()) + sum(stats[1].values())
+            if done % config.REPLAY_BATCH_SIZE == 0 or done == len(jobs):
+                if batch:
+                    save_replayed(batch)
+                    saved += len(batch)
+                    batch = []
+                report(progress(done, len(jobs), words, time.time() - time0))
+    finally:
+        pool.terminate()
+        stop_tagger_service()
+
+    for error in logs:
+        _log.error(error)
+    if saved:
+        _log.info(rebuild_top_words())
+    return "Replayed {} front pages out of {} snapshots in {} secs.".\
+           format(saved, len(jobs), str(time.time() - time0))
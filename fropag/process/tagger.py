@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""This module keeps Stanford taggers warm during a reading session.
+
+Launching the Stanford tagger means starting a JVM and loading
+the french model, which costs more than the tagging itself.
+Instead of doing this for every front page, start_tagger_service
+launches a pool of taggers reading tokens on their standard input,
+and a small local socket server handing requests to them.
+Any process (including the ones forked by the read_process module)
+can then tag tokens through tag_tokens (or many lists of tokens
+at once, through tag_batch) until stop_tagger_service is called."""
+
+import itertools
+import json
+import logging
+import queue
+import socket
+import socketserver
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+TAGGER_MODEL = 'stanford/french.tagger'
+TAGGER_JAR = 'stanford/stanford-postagger.jar'
+TAGGER_MAIN_CLASS = 'edu.stanford.nlp.tagger.maxent.MaxentTagger'
+JAVA_OPTIONS = ['-mx1000m']
+TAG_SEPARATOR = '_'
+
+_log = logging.getLogger('fropag.tagger')
+
+class TaggerException(Exception):
+    '''This exception should be raised when a tagger process
+    cannot give an answer : it died, or it sent back something
+    we cannot understand.'''
+    def __init__(self, value):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+
+def split_evenly(elements, parts):
+    """Split a list in at most parts contiguous chunks of similar sizes.
+
+    >>> split_evenly([1, 2, 3, 4, 5], 2)
+    [[1, 2, 3], [4, 5]]
+    >>> split_evenly([1], 3)
+    [[1]]
+    >>> split_evenly([], 3)
+    []
+    """
+    size = max(1, -(-len(elements) // max(1, parts)))
+    return [elements[i:i + size] for i in range(0, len(elements), size)]
+
+def parse_tagged_line(line):
+    """Transform a line of the Stanford tagger output
+    to a list of (word, tag) pairs.
+
+    >>> parse_tagged_line('Le_DET chat_NC dort_V ._PUNC')
+    [('Le', 'DET'), ('chat', 'NC'), ('dort', 'V'), ('.', 'PUNC')]
+    >>> parse_tagged_line('mot_avec_tiret_NC')
+    [('mot_avec_tiret', 'NC')]
+    """
+    return [tuple(pair.rsplit(TAG_SEPARATOR, 1)) for pair in line.split()]
+
+class TaggerWorker(object):
+    """One JVM running the Stanford tagger. Each line written
+    on its standard input is tagged as one sentence, and
+    answered by exactly one line on its standard output."""
+    def __init__(self, model=TAGGER_MODEL, jar=TAGGER_JAR):
+        self.model = model
+        self.jar = jar
+        self.process = None
+
+    def command(self):
+        '''Command line used to launch the tagger.'''
+        return (['java'] + JAVA_OPTIONS +
+                ['-cp', self.jar, TAGGER_MAIN_CLASS,
+                 '-model', self.model,
+                 '-tokenize', 'false',
+                 '-sentenceDelimiter', 'newline',
+                 '-encoding', 'utf-8'])
+
+    def start(self):
+        '''Launch the JVM.'''
+        self.process = subprocess.Popen(self.command(),
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL)
+
+    def is_alive(self):
+        '''Is the JVM still running ?'''
+        return self.process is not None and self.process.poll() is None
+
+    def tag(self, tokens):
+        '''Send a list of tokens to the tagger and
+        return the list of (word, tag) pairs.'''
+        return self.tag_sentences([tokens])[0]
+
+    def tag_sentences(self, sentences):
+        '''Send several lists of tokens to the tagger in one go
+        and return, for each of them, the list of (word, tag) pairs.'''
+        lines = [' '.join(t for t in tokens if t.strip())
+                 for tokens in sentences]
+        to_send = [line for line in lines if line]
+        # Write from another thread : the tagger will stop reading
+        # its input if we do not empty its output.
+        writer = threading.Thread(target=self._write_lines, args=(to_send,))
+        writer.start()
+        try:
+            answers = [self._read_answer() for _ in to_send]
+        finally:
+            writer.join()
+        answers.reverse()
+        return [parse_tagged_line(answers.pop()) if line else []
+                for line in lines]
+
+    def _write_lines(self, lines):
+        '''Feed the tagger. If it dies meanwhile, the reading side
+        will notice it.'''
+        try:
+            for line in lines:
+                self.process.stdin.write((line + '\n').encode('utf-8'))
+            self.process.stdin.flush()
+        except OSError:
+            pass
+
+    def _read_answer(self):
+        '''Read the tagging of one line.'''
+        answer = self.process.stdout.readline()
+        if not answer:
+            raise TaggerException('Tagger process exited with code {}'.\
+                                  format(self.process.poll()))
+        return answer.decode('utf-8')
+
+    def stop(self, timeout=5):
+        '''Close the tagger input so the JVM can exit,
+        and kill it if it does not.'''
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    def restart(self):
+        '''Replace a dead (or misbehaving) JVM with a new one.'''
+        self.stop()
+        self.start()
+
+class TaggerPool(object):
+    """A fixed number of TaggerWorkers. A worker is lent to only
+    one request at a time; crashed workers are restarted."""
+    def __init__(self, size, model=TAGGER_MODEL, jar=TAGGER_JAR):
+        self.workers = [TaggerWorker(model, jar) for _ in range(max(1, size))]
+        self.idle = queue.Queue()
+
+    def start(self):
+        '''Launch every worker.'''
+        for worker in self.workers:
+            worker.start()
+            self.idle.put(worker)
+
+    def tag_sentences(self, sentences):
+        '''Tag lists of tokens, splitting them between
+        every worker of the pool.'''
+        chunks = split_evenly(sentences, len(self.workers))
+        if len(chunks) < 2:
+            return self._tag_chunk(sentences)
+        with ThreadPoolExecutor(len(chunks)) as executor:
+            tagged = executor.map(self._tag_chunk, chunks)
+            return list(itertools.chain.from_iterable(tagged))
+
+    def _tag_chunk(self, sentences):
+        '''Tag lists of tokens with the first idle worker.
+        If the worker crashes, restart it and try once more.'''
+        worker = self.idle.get()
+        try:
+            for attempt in range(2):
+                if not worker.is_alive():
+                    _log.warning('Restarting a dead tagger.')
+                    worker.restart()
+                try:
+                    return worker.tag_sentences(sentences)
+                except (OSError, TaggerException) as exc:
+                    _log.error('Tagger failure : %s', exc)
+                    worker.restart()
+            raise TaggerException('Tagger failed twice in a row.')
+        finally:
+            self.idle.put(worker)
+
+    def stop(self):
+        '''Stop every worker.'''
+        for worker in self.workers:
+            worker.stop()
+
+class TaggerRequestHandler(socketserver.StreamRequestHandler):
+    """Read batches of lists of tokens (one JSON batch per line) and
+    answer with batches of lists of [word, tag] (one JSON batch per line)."""
+    def handle(self):
+        for line in self.rfile:
+            try:
+                sentences = json.loads(line.decode('utf-8'))
+                answer = self.server.pool.tag_sentences(sentences)
+            except (ValueError, TaggerException) as exc:
+                answer = {'error': str(exc)}
+            self.wfile.write(json.dumps(answer).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+class TaggerServer(socketserver.ThreadingTCPServer):
+    """Local socket server in front of a TaggerPool."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, pool):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0),
+                                                 TaggerRequestHandler)
+        self.pool = pool
+
+_server = None
+_address = None
+
+def start_tagger_service(size):
+    '''Launch a pool of size taggers and the local server
+    in front of them. Must be called before forking workers
+    that will need the tagger.'''
+    global _server, _address
+    if _server is not None:
+        return _address
+    pool = TaggerPool(size)
+    pool.start()
+    _server = TaggerServer(pool)
+    _address = _server.server_address
+    threading.Thread(target=_server.serve_forever, daemon=True).start()
+    _log.info('Tagger service with %d taggers listening on %s:%d',
+              size, _address[0], _address[1])
+    return _address
+
+def stop_tagger_service():
+    '''Stop the local server and every tagger of the pool.'''
+    global _server, _address
+    if _server is None:
+        return
+    _server.shutdown()
+    _server.server_close()
+    _server.pool.stop()
+    _server = None
+    _address = None
+    _log.info('Tagger service stopped.')
+
+def use_tagger_service(address):
+    '''Talk to the tagger service listening at address. Used
+    by processes that did not start the service themselves.'''
+    global _address
+    _address = address
+
+def is_running():
+    '''Is there a tagger service we can talk to ?'''
+    return _address is not None
+
+def tag_tokens(tokens):
+    '''Send tokens to the tagger service and
+    return the list of (word, tag) pairs.'''
+    return tag_batch([tokens])[0]
+
+def tag_batch(sentences):
+    '''Send several lists of tokens to the tagger service
+    in a single request, and return, for each of them,
+    the list of (word, tag) pairs.'''
+    request = [list(tokens) for tokens in sentences]
+    with socket.create_connection(_address) as connection:
+        stream = connection.makefile('rwb')
+        stream.write(json.dumps(request).encode('utf-8') + b'\n')
+        stream.flush()
+        line = stream.readline()
+    if not line:
+        raise TaggerException('Tagger service closed the connection.')
+    answer = json.loads(line.decode('utf-8'))
+    if isinstance(answer, dict):
+        raise TaggerException(answer['error'])
+    return [[tuple(pair) for pair in tagged] for tagged in answer]
@@ -1,5 +1,11 @@
 import unittest
 import datetime
+import os
+import tempfile
+import threading
+import time
+import queue
+import http.server
 from collections import Counter
 import config
 from sqlalchemy import func
@@ -8,7 +14,19 @@ from sqlalchemy.orm import sessionmaker, scoped_session
 from database import *
 from model.publication import *
 from model.core import *
-from process.read_process import save_words
+from model.rollup import rebuild_rollups
+from model.partition import forget_partitions, forget_months_before
+from model.analytics import sync_analytics, duckdb_engine
+import model.matrix
+from model.matrix import load_matrix, current_matrix, matrix_is_current
+from process.read_process import save_words, save_all, forget_word_ids
+from process.read_process import save_from_queue
+from process.fetcher import fetch_all
+from process.reader import process_front_page, extract_content
+from process.reader import load_fingerprints, get_previous_frontpage
+from process.reader import get_validators, keep_snapshot
+from process import archive
+from process.replay import replay_jobs, archived_snapshots, replay
 
 class DBTesting(unittest.TestCase):
     def setUp(self):
@@ -17,6 +35,8 @@ class DBTesting(unittest.TestCase):
         config.DB_NAME = "testFropag"
         boot_sql_alchemy()
         Base.metadata.create_all(engine)
+        forget_word_ids()
+        forget_partitions()
 
     def tearDown(self):
         Base.metadata.drop_all(engine)
@@ -35,6 +55,24 @@ class BasicHighLevelFunctions(DBTesting):
         except:
             self.fail("Couldn't fetch ONE result for query.")
 
+    def test_engines_after_fork(self):
+        follow_publication("Test", "")
+        parent_engine = get_engine()
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # The child gets its own engine, and can read
+            found = get_engine() is not parent_engine and \
+                    1 == get_read_engine().execute(
+                        "SELECT count(*) FROM publication").scalar()
+            os.write(write_end, b'1' if found else b'0')
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(b'1', os.read(read_end, 1))
+        # The connections of the parent still work
+        self.assertEqual(1, parent_engine.execute(
+                                "SELECT count(*) FROM publication").scalar())
+
 class DatabaseExtraction(DBTesting):
     def follow_two_publications(self):
         # Insert two publications for every test requiring some publications
@@ -76,6 +114,208 @@ class DatabaseExtraction(DBTesting):
         save_words(self.nfp2.id, proper_counter2, common_counter2)
         save_words(self.nfp3.id, proper_counter3, common_counter3)
 
+    def test_word_ids(self):
+        self.follow_two_publications()
+        self.create_three_frontpages()
+        save_words(self.nfp1.id, Counter({'Paris' : 1}),
+                   Counter({'paris' : 2, 'vote' : 1}))
+        forget_word_ids()
+        save_words(self.nfp2.id, Counter({'Paris' : 1}),
+                   Counter({'vote' : 3, 'loi' : 1}))
+        # Known words are not added twice, even without the cache.
+        self.assertEqual(4, db_session.query(Word).count())
+        self.assertEqual(2, db_session.query(Word).\
+                            filter(Word.word.in_(['Paris', 'paris'])).count())
+        self.assertEqual(6, db_session.query(WordCount).count())
+
+    def test_save_all(self):
+        self.follow_two_publications()
+        save_all([(self.pub1, (Counter({'Paris' : 1}),
+                               Counter({'vote' : 2}), 0.5)),
+                  (self.pub2, (Counter(), Counter({'vote' : 1}), 1.0))])
+        self.assertEqual(2, db_session.query(FrontPage).count())
+        self.assertEqual(3, db_session.query(WordCount).count())
+        self.assertEqual(3, db_session.query(func.sum(WordCount.count)).\
+                            join(Word).filter(Word.word == 'vote').scalar())
+
+    def test_rollups(self):
+        self.add_basic_data()
+        def counts():
+            return sorted((d.publication_id, d.word_id, d.day, d.count)
+                          for d in db_session.query(DailyWordCount))
+        # word1 : 2 on the 1st and 1 on the 2nd for Test1
+        self.assertEqual(dict(see_words_for("Test1", False))['word1'], 3)
+        incremental = counts()
+        rebuild_rollups()
+        self.assertEqual(incremental, counts())
+        delete_front_page(self.nfp2.id)
+        self.assertEqual(dict(see_words_for("Test1", False))['word1'], 2)
+        self.assertEqual(1, db_session.query(func.sum(
+                                DailyFrontPageCount.count)).\
+                            filter(DailyFrontPageCount.publication_id ==
+                                   self.pub1).scalar())
+        delete_publication(self.pub2)
+        self.assertEqual(0, db_session.query(DailyWordCount).\
+                            filter(DailyWordCount.publication_id ==
+                                   self.pub2).count())
+
+    def test_replay_twice(self):
+        self.follow_two_publications()
+        with tempfile.TemporaryDirectory() as folder:
+            os.mkdir(os.path.join(folder, "Test1"))
+            for name, text in (("1999-01-01.html", "Le vote de la loi."),
+                               ("1999-01-02.html", "Le vote du budget.")):
+                with open(os.path.join(folder, "Test1", name), 'w') as page:
+                    page.write('<html><body><p>{}</p></body></html>'.\
+                               format(text))
+            def totals():
+                return (db_session.query(FrontPage).count(),
+                        db_session.query(func.sum(WordCount.count)).scalar(),
+                        db_session.query(func.sum(DailyWordCount.count)).\
+                        scalar())
+            replay(folder, report=lambda message: None)
+            first = totals()
+            self.assertEqual(2, first[0])
+            # Replaying replaces the front pages saved for the same dates
+            replay(folder, report=lambda message: None)
+            self.assertEqual(first, totals())
+
+    def test_replay_after_read(self):
+        follow_publication("Test", "http://www.test.fr/")
+        p_id = db_session.query(Publication.id).scalar()
+        page = '<html><body><p>Le vote de la loi.</p></body></html>'
+        with tempfile.TemporaryDirectory() as folder:
+            previous_archive_dir = archive.ARCHIVE_DIR
+            archive.ARCHIVE_DIR = folder
+            try:
+                # What the saver of a reading does
+                to_save = queue.Queue()
+                to_save.put((p_id, (Counter(), Counter({'vote' : 1}), 1.0)))
+                to_save.put(None)
+                save_from_queue(to_save, [],
+                                {p_id : ("http://www.test.fr/",
+                                         archive.store_snapshot(page), {})})
+            finally:
+                archive.ARCHIVE_DIR = previous_archive_dir
+            replay(folder, report=lambda message: None)
+        # The front page of the reading was replaced, not added again
+        self.assertEqual(1, db_session.query(FrontPage).count())
+        self.assertEqual(1, db_session.query(func.sum(
+                                DailyFrontPageCount.count)).scalar())
+
+    def test_partitions(self):
+        self.follow_two_publications()
+        save_all([(self.pub1, (Counter(), Counter({'vote' : 2}), 0.5))])
+        db_session.begin()
+        old_front_page = FrontPage(publication_id = self.pub2,
+                                   time_of_publication =
+                                   datetime.datetime(1999, 1, 1, 12))
+        db_session.add(old_front_page)
+        db_session.commit()
+        save_words(old_front_page.id, Counter(), Counter({'vote' : 1}))
+        # Word counts carry the date of their front page
+        self.assertEqual(old_front_page.time_of_publication,
+                         db_session.query(WordCount.time_of_publication).\
+                         filter(WordCount.frontpage_id ==
+                                old_front_page.id).scalar())
+        self.assertEqual(1, engine.execute("SELECT count(*) FROM "
+                                           "wordcount_1999_01").scalar())
+        forget_months_before(datetime.date(2000, 1, 1))
+        self.assertEqual(1, db_session.query(FrontPage).count())
+        self.assertEqual(1, db_session.query(WordCount).count())
+        self.assertEqual(0, db_session.query(DailyWordCount).\
+                            filter(DailyWordCount.publication_id ==
+                                   self.pub2).count())
+
+    def check_analytics(self, backend):
+        self.add_basic_data()
+        rebuild_top_words()
+        charts = lambda: (get_all_tops(), get_history_for('word1'),
+                          get_publication_frequency(["Test1", "Test2"]),
+                          snapshot_all_tops())
+        expected = charts()
+        with tempfile.TemporaryDirectory() as folder:
+            config.ANALYTICS_BACKEND = backend
+            config.ANALYTICS_PATH = os.path.join(folder, 'analytics.db')
+            try:
+                sync_analytics()
+                boot_sql_alchemy()
+                self.assertEqual(backend, get_read_engine().name)
+                self.assertEqual(expected, charts())
+            finally:
+                config.ANALYTICS_BACKEND = None
+                boot_sql_alchemy()
+
+    def test_analytics(self):
+        self.check_analytics('sqlite')
+
+    @unittest.skipIf(duckdb_engine is None, "duckdb_engine is not installed.")
+    def test_analytics_duckdb(self):
+        self.check_analytics('duckdb')
+
+    def test_matrix(self):
+        self.add_basic_data()
+        modify_word(db_session.query(Word).filter(Word.word == 'word2').\
+                    one().id, False, False, [self.pub1])
+        matrix = load_matrix()
+        self.assertEqual(get_all_tops(), matrix.all_tops())
+        self.assertEqual(get_publication_most_used("Test1"),
+                         matrix.most_used("Test1"))
+        self.assertEqual(get_publication_frequency(["Test1", "Test2"]),
+                         matrix.frequency(["Test1", "Test2"]))
+        for bucket in BUCKETS:
+            self.assertEqual(get_history_for('word1', bucket=bucket),
+                             matrix.history('word1', bucket=bucket))
+
+    @unittest.skipIf(model.matrix.numpy is None, "NumPy is not installed.")
+    def test_matrix_is_current(self):
+        self.add_basic_data()
+        generation = get_generation()
+        self.assertTrue(matrix_is_current(generation))
+        config.COUNT_MATRIX = True
+        try:
+            current_matrix()
+            # Wait for the thread loading the matrix
+            with model.matrix._loading:
+                pass
+            self.assertTrue(matrix_is_current(generation))
+            bump_generation()
+            self.assertFalse(matrix_is_current(get_generation()))
+        finally:
+            config.COUNT_MATRIX = False
+
+    def test_generation(self):
+        self.add_basic_data()
+        generation = get_generation()
+        save_all([(self.pub1, (Counter(), Counter({'vote' : 2}), 0.5))])
+        self.assertTrue(get_generation() > generation)
+        generation = get_generation()
+        modify_word(db_session.query(Word).filter(Word.word == 'vote').\
+                    one().id, False, True, [])
+        self.assertTrue(get_generation() > generation)
+        generation = get_generation()
+        delete_front_page(self.nfp1.id)
+        self.assertTrue(get_generation() > generation)
+        generation = get_generation()
+        delete_publication(self.pub2)
+        self.assertTrue(get_generation() > generation)
+
+    def test_top_words_snapshot(self):
+        self.add_basic_data()
+        rebuild_top_words()
+        self.assertEqual(dict(snapshot_all_tops()['commons']),
+                         dict((w, float(c)) for w, c
+                              in get_all_tops()['commons']))
+        most_used = snapshot_publication_most_used("Test1")
+        self.assertEqual(most_used['mindate'], '01/01/1999')
+        self.assertEqual(dict(most_used['commons'])['word1'], 3)
+        self.assertEqual(list(snapshot_publication_frequency(["Test2"])),
+                         ["Test2"])
+        # Forbidding a word updates the snapshot
+        word1 = db_session.query(Word).filter(Word.word == 'word1').one()
+        modify_word(word1.id, False, True, [])
+        self.assertFalse('word1' in dict(snapshot_all_tops()['commons']))
+
     def test_get_dates(self):
         '''Bug tracked the 10/17/2014 : dates did not appear
         on the main page.'''
@@ -88,6 +328,16 @@ class DatabaseExtraction(DBTesting):
         self.assertEqual(test2['mindate'], '01/01/1999')
         self.assertEqual(test2['maxdate'], '01/01/1999')
 
+    def test_top_limit(self):
+        self.add_basic_data()
+        result = separate_propers_and_commons(word_counting_query(), 1)
+        self.assertEqual(result['commons'], [('word1', 15)])
+        # Ties are ranked alphabetically
+        self.assertEqual(result['propers'], [('proper1', 2)])
+        # Dates span every word, not only the first ones
+        self.assertEqual(result['mindate'], '01/01/1999')
+        self.assertEqual(result['maxdate'], '02/01/1999')
+
     def test_get_words(self):
         self.add_basic_data()
         result = [v[:2] for v in see_words_for("Test1", False)]
@@ -170,6 +420,36 @@ class DatabaseExtraction(DBTesting):
         # W3 should be there and fully counted
         self.assertEqual(full_words[w3.word], 18)
 
+    def test_forbidden_for_several(self):
+        '''A word forbidden for several publications used to be
+        counted once per forbidding publication for the others.'''
+        self.follow_two_publications()
+        follow_publication("Test3", "")
+        pub3 = db_session.query(Publication).\
+               filter(Publication.name == "Test3").one().id
+        self.create_three_frontpages()
+        db_session.begin()
+        front_page4 = FrontPage(publication_id = pub3,
+                                time_of_publication =
+                                datetime.datetime(1999, 1, 3, 12, 12, 12))
+        db_session.add(front_page4)
+        db_session.commit()
+        save_words(self.nfp1.id, Counter(), Counter({'test' : 1}))
+        save_words(self.nfp3.id, Counter(), Counter({'test' : 2}))
+        save_words(front_page4.id, Counter(), Counter({'test' : 4,
+                                                       'témoin' : 1}))
+        test = db_session.query(Word).filter(Word.word == 'test').one()
+        db_session.begin()
+        db_session.add(Forbidden(word_id = test.id, publication_id = self.pub1))
+        db_session.add(Forbidden(word_id = test.id, publication_id = self.pub2))
+        db_session.commit()
+        full_words = dict((r[0], r[1]) for r in word_counting_query())
+        # Only counted for the third publication, and only once
+        self.assertEqual(full_words['test'], 4)
+        self.assertEqual(full_words['témoin'], 1)
+        self.assertEqual(dict(see_words_for("Test3", False))['test'], 4)
+        self.assertFalse('test' in dict(see_words_for("Test1", False)))
+
     def test_frequency(self):
         self.follow_two_publications()
         self.create_three_frontpages()
@@ -200,6 +480,12 @@ class DatabaseExtraction(DBTesting):
         self.assertEqual(resP2['common'], 2)
         self.assertEqual(resP2['frequent'], 5)
         self.assertTrue('rare' not in resP2.keys())
+        # Ranking every publication at once gives the same results
+        both = get_publication_frequency(["Test1", "Test2"])
+        self.assertEqual(dict(both['Test1']['commons']), resP1)
+        self.assertEqual(dict(both['Test2']['commons']), resP2)
+        self.assertEqual(list(get_publication_frequency(["Test2"])),
+                         ["Test2"])
 
     def test_timed_word(self):
         self.follow_two_publications()
@@ -223,5 +509,194 @@ class DatabaseExtraction(DBTesting):
         self.assertEqual(peaking[1][2], 0)
         self.assertEqual(peaking[1][2], 0)
 
+    def test_history_buckets(self):
+        self.follow_two_publications()
+        self.create_three_frontpages()
+        save_words(self.nfp1.id, Counter(), Counter({'peaking' : 1}))
+        save_words(self.nfp2.id, Counter(), Counter({'peaking' : 10}))
+        save_words(self.nfp3.id, Counter(), Counter({'peaking' : 2}))
+        by_month = get_history_for('peaking', bucket='month')
+        self.assertEqual(by_month, [['date', 'Test1', 'Test2'],
+                                    ['1999/01/01', 11, 2]])
+        bounded = get_history_for('peaking',
+                                  start=datetime.date(1999, 1, 2),
+                                  end=datetime.date(1999, 1, 4))
+        # Days without front pages are filled with 0
+        self.assertEqual(bounded, [['date', 'Test1', 'Test2'],
+                                   ['1999/01/02', 10, 0],
+                                   ['1999/01/03', 0, 0],
+                                   ['1999/01/04', 0, 0]])
+        columns = get_history_for('peaking', bucket='month', columnar=True)
+        self.assertEqual(columns, {'dates' : ['1999/01/01'],
+                                   'series' : {'Test1' : [11],
+                                               'Test2' : [2]}})
+        # Spans longer than HISTORY_MAX_BUCKETS are refused
+        self.assertRaises(ValueError, get_history_for, 'peaking',
+                          datetime.date(1, 1, 1), datetime.date(9999, 12, 31))
+
+class CorpusTesting(unittest.TestCase):
+    """Tests writing in a temporary corpus directory."""
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        os.mkdir("corpus")
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+class ReaderTesting(CorpusTesting):
+    def test_fingerprints_sidecar(self):
+        template = '<div class="menu"><a>Choice1</a><a>Choice2</a></div>'
+        page1 = '<html><body>{}<p>One text.</p></body></html>'.format(template)
+        page2 = '<html><body>{}<p>Another text.</p></body></html>'.\
+                format(template)
+        process_front_page("http://test", page1)
+        keep_snapshot("http://test", archive.digest_of(page1), {})
+        prints = load_fingerprints("http://test")
+        self.assertTrue(len(prints) > 0)
+        prints.close()
+        # The fingerprints give the same result as the previous page
+        self.assertEqual(process_front_page("http://test", page2),
+                         extract_content(page1, page2))
+        keep_snapshot("http://test", archive.digest_of(page2), {})
+        self.assertEqual(process_front_page("http://test", page2), '')
+
+    def test_kept_once_saved(self):
+        page = '<html><body><p>Un texte.</p></body></html>'
+        self.assertEqual(process_front_page("http://test", page), 'Un texte.')
+        # Until the front page is saved, it must be read again,
+        # and is not the version the next one is compared with.
+        self.assertEqual(get_validators("http://test"), {})
+        self.assertEqual(process_front_page("http://test", page), 'Un texte.')
+        keep_snapshot("http://test", archive.digest_of(page), {'hash' : 'a'})
+        self.assertEqual(get_validators("http://test"), {'hash' : 'a'})
+        self.assertEqual(process_front_page("http://test", page), '')
+
+    def test_archive(self):
+        url = "http://www.test.fr/une/"
+        self.assertEqual(get_previous_frontpage(url), None)
+        first = archive.save_snapshot(url, "<p>Un</p>",
+                                      datetime.datetime(1999, 1, 1))
+        second = archive.save_snapshot(url, "<p>Deux</p>")
+        third = archive.save_snapshot(url, "<p>Un</p>")
+        # Identical versions are stored once
+        self.assertEqual(first, third)
+        self.assertEqual(len(archive.all_digests()), 2)
+        self.assertEqual(len(archive.snapshots_of(url)), 3)
+        self.assertEqual(archive.snapshots_of(url)[0][0],
+                         datetime.datetime(1999, 1, 1))
+        self.assertEqual(archive.latest_snapshot(url)[1], first)
+        self.assertEqual(get_previous_frontpage(url), "<p>Un</p>")
+        self.assertEqual(archive.archived_keys(), ["www.test.fr/une/"])
+
+    def test_replay_jobs(self):
+        url = "http://www.test.fr/une/"
+        template = '<div class="menu"><a>Choix</a></div>'
+        for day, text in ((1, 'Un'), (2, 'Deux'), (3, 'Deux')):
+            archive.save_snapshot(url, '<html><body>{}<p>{}</p></body></html>'.\
+                                  format(template, text),
+                                  datetime.datetime(1999, 1, day))
+        publication = Publication(id=1, name="Test", url=url)
+        jobs = replay_jobs([publication], archived_snapshots)
+        # The third reading gave the same page : nothing to replay.
+        self.assertEqual([job[2].day for job in jobs], [1, 2])
+        self.assertEqual(jobs[0][3], None)
+        self.assertEqual(jobs[1][3], jobs[0][4])
+        self.assertEqual(extract_content(archive.read_snapshot_file(jobs[1][3]),
+                                         archive.read_snapshot_file(jobs[1][4])),
+                         'Deux')
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    """Local stand-in for the news sites."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path.startswith('/slow'):
+            time.sleep(2)
+        if self.path == '/missing':
+            self.send_error(404)
+            return
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = 'Une page sur {}'.format(self.path).encode('latin-1')
+        self.send_response(200)
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Type', 'text/html; charset=latin-1')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class FetcherTesting(CorpusTesting):
+    def setUp(self):
+        # Validators are saved in the corpus directory
+        CorpusTesting.setUp(self)
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                      StandInHandler)
+        threading.Thread(target=self.server.serve_forever).start()
+        self.base = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.pages = {}
+        self.validators = {}
+        self.errors = {}
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        CorpusTesting.tearDown(self)
+
+    def on_page(self, path, page, validators):
+        self.pages[path] = page
+        self.validators[path] = validators
+
+    def fetch(self, paths, validators=None, **kwargs):
+        fetch_all([(p, self.base + p, validators or {}) for p in paths],
+                  self.on_page, self.errors.__setitem__, **kwargs)
+
+    def test_fetch_pages(self):
+        self.fetch(['/un', '/deux', '/missing'], max_in_flight=2)
+        self.assertEqual(self.pages['/un'], 'Une page sur /un')
+        self.assertEqual(self.pages['/deux'], 'Une page sur /deux')
+        self.assertTrue('/missing' in self.errors)
+
+    def test_request_timeout(self):
+        self.fetch(['/un', '/slow'], request_timeout=1)
+        self.assertTrue('/un' in self.pages)
+        self.assertTrue('/slow' in self.errors)
+
+    def test_not_modified(self):
+        self.fetch(['/un'], {'etag': '"v1"'})
+        self.assertEqual(self.pages['/un'], None)
+
+    def test_same_content(self):
+        self.fetch(['/un'])
+        self.assertEqual(self.validators['/un']['etag'], '"v1"')
+        known = dict(self.validators['/un'], etag='"v0"')
+        self.pages = {}
+        self.fetch(['/un'], known)
+        # Without the right ETag, the page is sent, but its hash
+        # tells us it did not change.
+        self.assertEqual(self.pages['/un'], None)
+
+    def test_queued_requests(self):
+        # Each request takes 2 secs : the third one waits 4 secs
+        # for a slot, which does not count in its timeout.
+        self.fetch(['/slow', '/slow2', '/slow3'], max_in_flight=1,
+                   request_timeout=3)
+        self.assertEqual(self.errors, {})
+        self.assertEqual(len(self.pages), 3)
+
+    def test_run_timeout(self):
+        time0 = time.time()
+        self.fetch(['/un', '/slow'], request_timeout=10, run_timeout=1)
+        self.assertTrue(time.time() - time0 < 2)
+        self.assertTrue('/un' in self.pages)
+        self.assertTrue('/slow' in self.errors)
+
 if __name__ == "__main__":
     unittest.main()
@@ -3,13 +3,17 @@ import os
 from flask import Flask
 from flask.ext.assets import Environment, Bundle
 from model.core import boot_sql_alchemy
-from database import db_session
+from model.analytics import ensure_analytics
+from model.matrix import current_matrix
+from database import db_session, read_session
 import config
 
 # Booting flask app
 app = Flask(__name__)
 app.secret_key = config.SECRET_KEY
 boot_sql_alchemy()
+ensure_analytics()
+current_matrix()
 
 # Assets
 # ASSETS
@@ -34,8 +38,9 @@ assets.register(
 
 @app.teardown_appcontext
 def shutdown_session(exception=None):
-    '''Close the db_session when context ends.'''
+    '''Close the sessions when context ends.'''
     db_session.remove()
+    read_session.remove()
 
 # Loading views
 import web.public_views
@@ -4,6 +4,7 @@ from flask import render_template, request, session, redirect, url_for
 
 import config
 from web import app
+from database import reads_from_primary
 from model.core import get_word_data, NonExistingDataException
 from model.core import get_publications, follow_publication
 from model.core import delete_publication, modify_publication
@@ -44,7 +45,9 @@ def login():
 def admin_word(word):
     '''Administration page for a single word.'''
     try:
-        word_data = get_word_data(word)
+        # What was just modified may not be on the replica yet
+        with reads_from_primary():
+            word_data = get_word_data(word)
         return render_template('admin_word.html',
                                w=word_data['word'],
                                publications=word_data['publications'],
@@ -56,8 +59,10 @@ def admin_word(word):
 @login_required
 def admin_publications():
     """Access to the publication administration menu."""
+    with reads_from_primary():
+        publications = get_publications()
     return render_template('admin_publications.html',
-                           publications=get_publications())
+                           publications=publications)
 
 @app.route('/publication/delete/<int:p_id>')
 @login_required
@@ -0,0 +1,101 @@
+'''Cache of the JSON answers of the services.
+
+Answers are kept by route and arguments, with the generation of
+the data they were computed from (see model.core.get_generation) :
+a reading or a change made by the administrator makes them outdated.
+Each answer has an ETag made of this generation and its key, so
+a browser asking again for an answer it has gets a 304, without
+anything being computed or sent. When the cache is full, the
+answers used least recently are dropped.
+Until the matrix of the word counts (see model.matrix) is loaded
+for the current generation, answers are neither cached nor tagged :
+they are those of the previous one.'''
+import collections
+import hashlib
+import threading
+from functools import wraps
+
+from flask import request
+
+import config
+from web import app
+from model.core import get_generation
+from model.matrix import matrix_is_current
+
+class LRUCache(object):
+    """Keep at most size values, dropping the least recently
+    used ones first.
+
+    >>> cache = LRUCache(2)
+    >>> cache.put('a', 1)
+    >>> cache.put('b', 2)
+    >>> cache.get('a')
+    1
+    >>> cache.put('c', 3)
+    >>> cache.get('b') is None
+    True
+    >>> list(cache.values)
+    ['a', 'c']
+    """
+    def __init__(self, size):
+        self.size = size
+        self.values = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.values:
+                return None
+            self.values.move_to_end(key)
+            return self.values[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.values[key] = value
+            self.values.move_to_end(key)
+            while len(self.values) > self.size:
+                self.values.popitem(last=False)
+
+_answers = LRUCache(config.RESPONSE_CACHE_SIZE)
+
+def request_key():
+    '''Route and arguments of the current request.'''
+    arguments = sorted(request.args.items(multi=True))
+    return request.path + '?' + '&'.join('{}={}'.format(name, value)
+                                         for name, value in arguments)
+
+def entity_tag(generation, key):
+    """ETag of the answer to a request, for a generation of the data.
+
+    >>> entity_tag(3, '/top_words_all/?')
+    '3-b3ac871804637da9'
+    """
+    return '{}-{}'.format(generation,
+                          hashlib.sha1(key.encode('utf-8')).hexdigest()[:16])
+
+def cached(view):
+    '''Answer with a 304 if the browser has the answer of the view
+    for the current data, or with the cached one if there is one.
+    Only successful answers, computed from the current data, are cached.'''
+    @wraps(view)
+    def cached_view(*args, **kwargs):
+        key = request_key()
+        generation = get_generation()
+        tag = entity_tag(generation, key)
+        if request.if_none_match.contains(tag):
+            response = app.response_class(status=304)
+        else:
+            answer = _answers.get((generation, key))
+            if answer is None:
+                current = matrix_is_current(generation)
+                response = app.make_response(view(*args, **kwargs))
+                if response.status_code != 200 or not current:
+                    return response
+                answer = (response.get_data(), response.mimetype)
+                _answers.put((generation, key), answer)
+            response = app.response_class(answer[0], mimetype=answer[1])
+        response.set_etag(tag)
+        # Browsers keep the answer, but check it is still the right one
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    return cached_view
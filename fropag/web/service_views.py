@@ -26,12 +26,17 @@ DataSet type
   'data' : [legend_row, data_rows] }
 '''
 
+import datetime
+
 from flask import request
 from flask.json import jsonify
 
 from web import app
-from model.core import get_all_tops, get_history_for
-from model.core import get_publication_frequency, get_publication_most_used
+from web.cache import cached
+from model.core import snapshot_all_tops, get_history_for, DAY
+from model.core import snapshot_publication_frequency
+from model.core import snapshot_publication_most_used
+from model.matrix import current_matrix
 
 # CONSTANTS
 #------------------------------
@@ -93,13 +98,29 @@ def to_successful_answer(data_set):
     return jsonify({'success': True,
                     'data': data_set})
 
+
+def to_failed_answer(message):
+    '''Answer type for a request we cannot answer.'''
+    return jsonify({'success': False,
+                    'error': message}), 400
+
+
+def date_argument(name):
+    '''Date given as a YYYY-MM-DD GET parameter, or None.'''
+    value = request.args.get(name)
+    if not value:
+        return None
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
 # ROUTES
 #------------------------------
 @app.route('/top_words_all/')
+@cached
 def get_top_words_all():
     '''Return a JSON with the top 10 common words and top 10 proper
     words for all publication combined.'''
-    top10 = get_all_tops()
+    matrix = current_matrix()
+    top10 = matrix.all_tops() if matrix else snapshot_all_tops()
     add_prelude(top10)
     data_set = separated_to_data_set(top10,
                                      TOP_10_ALL_COMMONS_TITLE,
@@ -107,29 +128,54 @@ def get_top_words_all():
     return to_successful_answer(data_set)
 
 @app.route('/word/history/<string:word>')
+@cached
 def get_history_for_word(word):
     '''Return the usage history of the word received in parameter.
+    GET parameters from and to (YYYY-MM-DD) bound the history,
+    and bucket (day, week or month) sets its granularity ; spans
+    of more than config.HISTORY_MAX_BUCKETS buckets are refused.
     Result is a JSON with the structure :
-    [date, newspaper1, newspaper2, ...]'''
-    info = get_history_for(word)
+    [date, newspaper1, newspaper2, ...]
+    or, with the GET parameter layout=columns :
+    { 'dates' : [...], 'series' : { 'newspaper1' : [...], ... } }'''
+    matrix = current_matrix()
+    history = matrix.history if matrix else get_history_for
+    try:
+        info = history(word,
+                       date_argument('from'),
+                       date_argument('to'),
+                       request.args.get('bucket', DAY),
+                       request.args.get('layout') == 'columns')
+    except ValueError as error:
+        return to_failed_answer(str(error))
     title = "Historique d'utilisation du mot {}.".format(word)
     data_set = {'title': title, 'data': info}
     return to_successful_answer(data_set)
 
 @app.route('/top_words_for/')
+@cached
 def get_top_words_for():
     '''Return the top words for a list of publications passed
     as an array in GET parameter. Result is a json dictionnary.'''
     names = request.args.getlist("names[]")
-    top_words_dict = get_publication_frequency(names)
+    matrix = current_matrix()
+    if matrix:
+        top_words_dict = matrix.frequency(names)
+    else:
+        top_words_dict = snapshot_publication_frequency(names)
     new_dict = prelude_stat_dictionary(top_words_dict, 10)
     return to_successful_answer(new_dict)
 
 @app.route('/publication/frequency/<string:publication>')
+@cached
 def most_used_words_of(publication):
     '''Return the 100th most used common words
     and the 100th most used proper words, as a dictionary.'''
-    top100 = get_publication_most_used(publication)
+    matrix = current_matrix()
+    if matrix:
+        top100 = matrix.most_used(publication)
+    else:
+        top100 = snapshot_publication_most_used(publication)
     add_prelude(top100)
     data_set = separated_to_data_set(top100,
                                      PRELUDE_COMMONS_TITLE.format(100,